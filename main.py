@@ -94,3 +94,21 @@ if __name__ == "__main__":
                           n_splits=5,
                           num_slices=7)
     '''
+    '''
+    # SEVERAL BEHAVIORS OF ONE LESION SET, loaded, filtered and kernelized once
+    from modules.run_svr_lsm_batch import run_svr_lsm_batch
+    symptom_folder = base_folder / 'VAST'
+    analyses = [
+        {'csv_name': "VAST_Data_Fluency.csv", 'behaviour_name': "Aphasia", 'max_score': 4, 'do_regress_out_lesion_volume': True},
+        {'csv_name': "VAST_Data_Naming.csv", 'behaviour_name': "Naming", 'max_score': 60, 'do_regress_out_lesion_volume': True},
+    ]
+    run_svr_lsm_batch(symptom_folder=symptom_folder,
+                      analyses=analyses,
+                      normalize_vector=True,
+                      min_patient_count="10%",
+                      param_grid=param_grid,
+                      n_permutations=1000,
+                      alpha=0.05,
+                      n_splits=5,
+                      num_slices=7)
+    '''
@@ -0,0 +1,86 @@
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from modules.null_distribution import NullStatistics
+
+RUN_CONFIG_NAME = "run_config.json"
+CHECKPOINT_NAME = "checkpoint.json"
+
+
+def write_json(path, content):
+    # Written to a temporary file first, so a crash never leaves a half-written file behind
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def save_run_config(output_folder, config):
+    """
+    Save the arguments of a run (paths as strings) to run_config.json, for resume_svr_lsm_iteration.
+    """
+    config = {name: str(value) if isinstance(value, Path) else value for name, value in config.items()}
+    write_json(Path(output_folder) / RUN_CONFIG_NAME, config)
+
+
+def load_run_config(output_folder):
+    with open(Path(output_folder) / RUN_CONFIG_NAME) as f:
+        return json.load(f)
+
+
+def save_checkpoint(output_folder, completed_permutations, seed_entropy, best_params, coef_map, null_statistics, retired):
+    """
+    Save the permutation state: the number of completed permutations (always a whole number of chunks),
+    the permutation seed, the best parameters, the beta map, the null accumulators and the voxels retired by an adaptive run.
+    The arrays go to a new checkpoint_<uuid>.npz; the previous one is only removed once checkpoint.json points to the new one.
+    svr_lsm saves it after the final fit, every checkpoint_interval seconds and on Ctrl-C; resume=True continues from
+    it without the search, with results bit-identical to an uninterrupted run.
+    """
+    output_folder = Path(output_folder)
+    previous = read_checkpoint_file(output_folder)
+    arrays_file = f"checkpoint_{uuid.uuid4().hex}.npz"
+    np.savez(output_folder / arrays_file, coef_map=coef_map, count=null_statistics.count, mean=null_statistics.mean,
+             m2=null_statistics.m2, exceedances=null_statistics.exceedances, maxima=null_statistics.maxima,
+             retired=retired)
+    write_json(output_folder / CHECKPOINT_NAME, {'completed_permutations': int(completed_permutations),
+                                                 'seed_entropy': seed_entropy,
+                                                 'best_params': best_params,
+                                                 'arrays_file': arrays_file})
+    if previous is not None:
+        try:
+            os.remove(output_folder / previous['arrays_file'])
+        except OSError:
+            pass
+
+
+def read_checkpoint_file(output_folder):
+    checkpoint_path = Path(output_folder) / CHECKPOINT_NAME
+    if not checkpoint_path.exists():
+        return None
+    with open(checkpoint_path) as f:
+        return json.load(f)
+
+
+def load_checkpoint(output_folder):
+    """
+    Load the last checkpoint of output_folder as a dict (see save_checkpoint), with coef_map, a NullStatistics
+    and the retired voxels, or None if there is none.
+    """
+    checkpoint = read_checkpoint_file(output_folder)
+    if checkpoint is None:
+        return None
+    with np.load(Path(output_folder) / checkpoint['arrays_file']) as arrays:
+        checkpoint['coef_map'] = arrays['coef_map']
+        checkpoint['retired'] = arrays['retired']
+        null_statistics = NullStatistics(len(arrays['mean']))
+        null_statistics.count = arrays['count']
+        null_statistics.mean = arrays['mean']
+        null_statistics.m2 = arrays['m2']
+        null_statistics.exceedances = arrays['exceedances']
+        null_statistics.maxima = arrays['maxima']
+    checkpoint['null_statistics'] = null_statistics
+    return checkpoint
\ No newline at end of file
@@ -0,0 +1,26 @@
+import numpy as np
+
+
+def compute_beta_map(svr, features, beta_weighting="mean"):
+    """
+    Voxel map of a fitted precomputed-kernel SVR, as one matvec of patient weights against the feature matrix.
+    beta_weighting="mean" gives the mean of the support vectors' feature rows,
+    "dual" the dual-weighted beta (dual_coef_ @ features[support_]).
+    No support-vector rows are copied: the weights are zero outside svr.support_.
+    The map has the features' dtype.
+    """
+    weights = np.zeros(features.shape[0], dtype=features.dtype)
+    if beta_weighting == "mean":
+        weights[svr.support_] = 1 / max(len(svr.support_), 1)
+    elif beta_weighting == "dual":
+        weights[svr.support_] = svr.dual_coef_[0]
+    else:
+        raise ValueError(f"Unknown beta_weighting '{beta_weighting}', expected 'mean' or 'dual'.")
+    # The weights share the features' dtype, so neither product upcasts (and copies) the feature matrix
+    return np.asarray(features.T @ weights).ravel()
+
+def compute_beta_maps(dual_coefs, features):
+    """
+    Dual-weighted beta maps of a (models x patients) block of dual coefficients, as one matrix product.
+    """
+    return np.asarray(features.T @ np.asarray(dual_coefs, dtype=features.dtype).T).T
\ No newline at end of file
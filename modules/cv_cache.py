@@ -0,0 +1,80 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+from modules.checkpoint import write_json
+
+CV_CACHE_NAME = "cv_score_cache"
+
+
+def dataset_fingerprint(sq_distances, behaviors, solver, model):
+    """
+    Hash of everything a cross-validation score depends on besides the fold and the parameters.
+    The patient x patient squared distances stand for the features (and so the filtering and normalisation),
+    the behaviors are the ones left after regressing out the covariates.
+    """
+    digest = hashlib.sha1()
+    digest.update(str(sq_distances.shape).encode())
+    digest.update(np.ascontiguousarray(sq_distances, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(behaviors, dtype=np.float64).tobytes())
+    digest.update(f"{solver}|{model}".encode())
+    return digest.hexdigest()
+
+
+def fold_hash(test_idx):
+    # The test indices identify a fold: the training patients are all the others
+    return hashlib.sha1(np.ascontiguousarray(test_idx, dtype=np.int64).tobytes()).hexdigest()[:16]
+
+
+class CVScoreCache:
+    """
+    Persistent (fold, C, gamma, epsilon) -> (test MSE, number of support vectors) store of one dataset fingerprint,
+    kept as <cache_folder>/<fingerprint>.json so that later runs on the same data only fit the grid points they add.
+    save() merges the entries with the ones other runs have written in the meantime.
+    """
+
+    def __init__(self, cache_folder, kernel_engine, behaviors, solver="libsvm", model="svr"):
+        self.cache_folder = Path(cache_folder)
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.path = self.cache_folder / f"{dataset_fingerprint(kernel_engine.sq_distances, behaviors, solver, model)}.json"
+        self.entries = self.read()
+        self.new_entries = {}
+        self.hits = 0
+        print(f"CV score cache: {len(self.entries)} fold scores in {self.path}")
+
+    def read(self):
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"Could not read the CV score cache {self.path}, starting a new one")
+            return {}
+
+    @staticmethod
+    def key(C, gamma, epsilon, test_idx):
+        return f"{fold_hash(test_idx)}|{float(C)!r}|{float(gamma)!r}|{float(epsilon)!r}"
+
+    def get(self, C, gamma, epsilon, test_idx):
+        # (mse, n_sv), or None if this fold was never fitted with these parameters
+        entry = self.entries.get(self.key(C, gamma, epsilon, test_idx))
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, C, gamma, epsilon, test_idx, score, n_sv):
+        key = self.key(C, gamma, epsilon, test_idx)
+        self.entries[key] = self.new_entries[key] = [float(score), int(n_sv)]
+
+    def save(self):
+        if not self.new_entries:
+            return
+        entries = self.read()
+        entries.update(self.new_entries)
+        write_json(self.path, entries)
+        self.entries = entries
+        self.new_entries = {}
\ No newline at end of file
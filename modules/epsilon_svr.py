@@ -0,0 +1,205 @@
+import numpy as np
+from sklearn.svm import SVR
+
+from modules.kernel_ridge import LeastSquaresSVR
+
+# Curvature used when the two-variable subproblem is not strictly convex, as in libsvm
+TAU = 1e-12
+
+
+class EpsilonSVR:
+    """
+    Epsilon-SVR on a precomputed kernel, solved by SMO with libsvm's second-order working set selection.
+
+    Unlike sklearn's SVR, fit() accepts an initial dual vector (beta = alpha - alpha*), so a solution
+    can be warm-started from a neighbouring problem, e.g. the previous C of a C path.
+    The fitted attributes follow sklearn's SVR: support_, dual_coef_, intercept_.
+    Every iteration is a few vector operations in numpy, so a cold fit is several times slower than libsvm's;
+    fit_svr only uses it for warm starts.
+    """
+
+    def __init__(self, C=1.0, epsilon=0.1, tol=1e-3, max_iter=10_000_000):
+        self.C = C
+        self.epsilon = epsilon
+        self.tol = tol
+        self.max_iter = max_iter
+
+    def fit(self, kernel, y, initial_dual=None):
+        kernel = np.asarray(kernel, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        n = len(y)
+        C = float(self.C)
+
+        # libsvm's 2n-variable form: alpha[:n] are the alphas, alpha[n:] the alpha*s, with labels +1 and -1.
+        # The solver keeps the labelled gradient y_k * G_k, whose two halves get the same update, a combination
+        # of two kernel rows, and caches the curvature K_ii + K_jj - 2 K_ij of every working variable i it selects.
+        signs = np.concatenate([np.ones(n), -np.ones(n)])
+        linear = np.concatenate([self.epsilon - y, self.epsilon + y])
+        kernel_diagonal = np.diag(kernel)
+        curvature_rows = {}
+
+        def curvature_row(row):
+            if row not in curvature_rows:
+                curvature = np.tile(kernel_diagonal[row] + kernel_diagonal - 2 * kernel[row], 2)
+                curvature[curvature <= 0] = TAU
+                curvature_rows[row] = curvature
+            return curvature_rows[row]
+
+        if initial_dual is None:
+            alpha = np.zeros(2 * n)
+            gradient = linear.copy()
+        else:
+            beta = warm_start_dual(initial_dual, C)
+            alpha = np.concatenate([np.maximum(beta, 0), np.maximum(-beta, 0)])
+            kernel_beta = kernel @ beta
+            gradient = np.concatenate([kernel_beta, -kernel_beta]) + linear
+        y_gradient = signs * gradient
+        y_gradient_halves = y_gradient.reshape(2, n)
+        # Variables that can move up (alpha < C, alpha* > 0) and down (alpha > 0, alpha* < C) along their label
+        up = np.concatenate([alpha[:n] < C, alpha[n:] > 0])
+        low = np.concatenate([alpha[:n] > 0, alpha[n:] < C])
+
+        n_iter = 0
+        while n_iter < self.max_iter:
+            i, j = select_working_set(y_gradient, up, low, curvature_row, self.tol)
+            if j < 0:
+                break
+            n_iter += 1
+
+            row_i, row_j = i % n, j % n
+            old_alpha_i, old_alpha_j = alpha[i], alpha[j]
+            alpha[i], alpha[j] = solve_two_variables(old_alpha_i, old_alpha_j, signs[i] * y_gradient[i], signs[j] * y_gradient[j],
+                                                     signs[i], signs[j], kernel_diagonal[row_i], kernel_diagonal[row_j],
+                                                     signs[i] * signs[j] * kernel[row_i, row_j], C)
+            y_gradient_halves += (kernel[row_i] * (signs[i] * (alpha[i] - old_alpha_i))
+                                  + kernel[row_j] * (signs[j] * (alpha[j] - old_alpha_j)))
+            for k in (i, j):
+                up[k] = alpha[k] < C if k < n else alpha[k] > 0
+                low[k] = alpha[k] > 0 if k < n else alpha[k] < C
+
+        beta = alpha[:n] - alpha[n:]
+        self.dual_ = beta
+        self.support_ = np.flatnonzero(beta)
+        self.dual_coef_ = beta[self.support_].reshape(1, -1)
+        self.intercept_ = np.array([-compute_rho(alpha, y_gradient, signs, C)])
+        self.n_iter_ = n_iter
+        return self
+
+    def predict(self, kernel):
+        # kernel: (test patients x training patients), as for SVR(kernel='precomputed')
+        kernel = np.asarray(kernel, dtype=np.float64)
+        return kernel[:, self.support_] @ self.dual_coef_[0] + self.intercept_[0]
+
+
+def warm_start_dual(initial_dual, C):
+    """
+    Make a dual vector feasible for a new C. The constraints sum(beta) = 0 and |beta| <= C do not depend
+    on the targets, so a previous solution only has to be scaled down when C shrinks.
+    """
+    beta = np.array(initial_dual, dtype=np.float64)
+    largest = np.max(np.abs(beta), initial=0.0)
+    if largest > C:
+        beta *= C / largest
+    return beta
+
+
+def select_working_set(y_gradient, up, low, curvature_row, tol):
+    """
+    libsvm's WSS on the labelled gradient: i maximises the violation, j the second-order decrease of the objective,
+    with curvature_row(i % patients) the K_ii + K_jj - 2 K_ij of every j (y_i * y_j * Q_ij = K_ij for both label pairs).
+    Returns j = -1 when the maximal violation is below tol.
+    """
+    up_values = np.where(up, -y_gradient, -np.inf)
+    i = int(np.argmax(up_values))
+    g_max = up_values[i]
+
+    grad_diff = g_max + np.where(low, y_gradient, -np.inf)
+    if np.max(grad_diff) < tol:
+        return i, -1
+    # Only down-movable variables with a positive gradient difference are candidates for j
+    decrease = np.where(grad_diff > 0, grad_diff * grad_diff / curvature_row(i % (len(y_gradient) // 2)), -np.inf)
+    j = int(np.argmax(decrease))
+    if decrease[j] == -np.inf:
+        return i, -1
+    return i, j
+
+
+def solve_two_variables(alpha_i, alpha_j, gradient_i, gradient_j, y_i, y_j, Q_ii, Q_jj, Q_ij, C):
+    # Analytic update of the two working variables, clipped to the box [0, C] (libsvm Solver::Solve)
+    if y_i != y_j:
+        quad_coef = Q_ii + Q_jj + 2 * Q_ij
+        if quad_coef <= 0:
+            quad_coef = TAU
+        delta = (-gradient_i - gradient_j) / quad_coef
+        diff = alpha_i - alpha_j
+        alpha_i += delta
+        alpha_j += delta
+        if diff > 0:
+            if alpha_j < 0:
+                alpha_j, alpha_i = 0.0, diff
+        elif alpha_i < 0:
+            alpha_i, alpha_j = 0.0, -diff
+        if diff > 0:
+            if alpha_i > C:
+                alpha_i, alpha_j = C, C - diff
+        elif alpha_j > C:
+            alpha_j, alpha_i = C, C + diff
+    else:
+        quad_coef = Q_ii + Q_jj - 2 * Q_ij
+        if quad_coef <= 0:
+            quad_coef = TAU
+        delta = (gradient_i - gradient_j) / quad_coef
+        total = alpha_i + alpha_j
+        alpha_i -= delta
+        alpha_j += delta
+        if total > C:
+            if alpha_i > C:
+                alpha_i, alpha_j = C, total - C
+        elif alpha_j < 0:
+            alpha_j, alpha_i = 0.0, total
+        if total > C:
+            if alpha_j > C:
+                alpha_j, alpha_i = C, total - C
+        elif alpha_i < 0:
+            alpha_i, alpha_j = 0.0, total
+    return alpha_i, alpha_j
+
+
+def compute_rho(alpha, y_gradient, signs, C):
+    # Offset from the free variables, or the middle of the feasible interval if there are none (libsvm calculate_rho)
+    at_upper = alpha >= C
+    at_lower = alpha <= 0
+    free = ~at_upper & ~at_lower
+    if free.any():
+        return np.mean(y_gradient[free])
+    upper_bound_set = (at_upper & (signs < 0)) | (at_lower & (signs > 0))
+    lower_bound_set = (at_upper & (signs > 0)) | (at_lower & (signs < 0))
+    upper = np.min(y_gradient[upper_bound_set], initial=np.inf)
+    lower = np.max(y_gradient[lower_bound_set], initial=-np.inf)
+    return (upper + lower) / 2
+
+
+def fit_svr(kernel, y, C, epsilon, solver="libsvm", initial_dual=None, model="svr"):
+    """
+    Fit an epsilon-SVR on a precomputed kernel with sklearn's libsvm (solver="libsvm")
+    or, with solver="smo", with the EpsilonSVR warm-started from initial_dual (the C path of the grid search).
+    Cold fits (no initial_dual: the first C of a path, the final fit and the permutations) use libsvm either way,
+    as EpsilonSVR is several times slower from zero.
+    model="kernel_ridge" fits a LeastSquaresSVR instead (epsilon and solver are then unused).
+    """
+    if model == "kernel_ridge":
+        return LeastSquaresSVR(C=C).fit(kernel, y)
+    if model != "svr":
+        raise ValueError(f"Unknown model '{model}', expected 'svr' or 'kernel_ridge'.")
+    if solver not in ("libsvm", "smo"):
+        raise ValueError(f"Unknown solver '{solver}', expected 'libsvm' or 'smo'.")
+    if solver == "smo" and initial_dual is not None:
+        return EpsilonSVR(C=C, epsilon=epsilon).fit(kernel, y, initial_dual)
+    return SVR(kernel='precomputed', C=C, epsilon=epsilon).fit(kernel, y)
+
+
+def full_dual(svr, n_patients):
+    # beta = alpha - alpha* of every training patient, zero outside the support
+    beta = np.zeros(n_patients)
+    beta[svr.support_] = svr.dual_coef_[0]
+    return beta
\ No newline at end of file
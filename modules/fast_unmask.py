@@ -0,0 +1,18 @@
+import nibabel as nib
+import numpy as np
+
+
+def fast_unmask(vector, voxel_index, reference_img, dtype=None):
+    """
+    Scatter feature values back into the 3D grid of reference_img, as dtype (the vector's own by default).
+    voxel_index holds the flat (C-order) grid index of every feature, as returned by filter_voxels_by_patient_count.
+    """
+    vector = np.asarray(vector)
+    volume = np.zeros(int(np.prod(reference_img.shape[:3])), dtype=vector.dtype if dtype is None else dtype)
+    volume[voxel_index] = vector
+    return nib.Nifti1Image(volume.reshape(reference_img.shape[:3]), reference_img.affine)
+
+
+def mask_voxel_index(mask_img):
+    # Flat grid index of every voxel of a mask, in the order nilearn's apply_mask uses
+    return np.flatnonzero(np.asanyarray(mask_img.dataobj) > 0).astype(np.int32)
\ No newline at end of file
@@ -1,13 +1,24 @@
 import nibabel as nib
 import numpy as np
+from nilearn.image import crop_img
 from sklearn.preprocessing import normalize
-from nilearn import masking
 
-def filter_voxels_by_patient_count(lesion_files, min_patient_count, normalize_vector, output_folder):
+from modules.fast_unmask import mask_voxel_index
+
+def filter_voxels_by_patient_count(lesion_matrix, min_patient_count, normalize_vector, output_folder, sparse=False, mask_mode="brain", dtype=np.float32):
     """
     Filter voxels by the number of patients they are involved in.
+    With sparse=True the features are returned as a CSR matrix, which svr_lsm fits directly.
+    The features have the given dtype; svr_lsm computes its maps in it.
+
+    Only the surviving voxels become feature columns; voxel_index holds their flat (int32) index in the masker grid,
+    for fast_unmask.
+
+    mask_mode="brain" keeps the brain mask as the analysis grid.
+    mask_mode="lesion_union" builds the analysis mask from the voxels lesioned in at least
+    max(1, min_patient_count) patients, cropped to their bounding box.
     """
-    no_of_patients = len(lesion_files)
+    no_of_patients = lesion_matrix.n_patients
     if not isinstance(min_patient_count, int):
         if isinstance(min_patient_count, str):
             if min_patient_count.endswith('%'):
@@ -25,29 +36,37 @@ def filter_voxels_by_patient_count(lesion_files, min_patient_count, normalize_ve
     else:
         print("Filtering is not done")
 
-    lesion_imgs = [nib.load(f) for f in lesion_files]
-    masker = masking.compute_brain_mask(lesion_imgs[0])
-    lesion_data = [masking.apply_mask(img, masker) for img in lesion_imgs]
-
-    # Stack the vectorized lesion data
-    lesion_data_stack = np.vstack(lesion_data)
+    # Count the number of patients each voxel is involved in (lesions are binary, so this is also the overlap)
+    voxel_patient_count = lesion_matrix.voxel_patient_count()
 
-    sum_of_vectors = np.sum(lesion_data_stack, axis=0)
-    sum_of_vectors = sum_of_vectors.astype(np.int32)  # Ensure integer type
-    sum_of_voxel_mni = masking.unmask(sum_of_vectors, masker)
+    sum_of_voxel_mni = lesion_matrix.unmask(voxel_patient_count)
     sum_of_vectors_path = output_folder / "lesion_overlap.nii.gz"
     nib.save(sum_of_voxel_mni, sum_of_vectors_path)
 
-    # Count the number of patients each voxel is involved in
-    voxel_patient_count = np.sum(lesion_data_stack > 0, axis=0)
-
     # Filter voxels
-    lesion_data_prepared = np.copy(lesion_data_stack)
-    lesion_data_prepared[:, voxel_patient_count < min_patient_count] = 0
+    filtered_voxels = voxel_patient_count < min_patient_count
+    if mask_mode == "lesion_union":
+        analysis_voxels = voxel_patient_count >= max(min_patient_count, 1)
+        if not analysis_voxels.any():
+            raise ValueError(f"No voxel is lesioned in at least {max(min_patient_count, 1)} patients.")
+        masker = crop_img(lesion_matrix.unmask(analysis_voxels.astype(np.int8)), copy_header=True)
+        print(f"Analysis mask from the lesion union, cropped to a {masker.shape} bounding box")
+        nib.save(masker, output_folder / "analysis_mask.nii.gz")
+        voxel_index = mask_voxel_index(masker)
+    elif mask_mode == "brain":
+        analysis_voxels = ~filtered_voxels
+        masker = lesion_matrix.mask_img
+        voxel_index = lesion_matrix.voxel_index[analysis_voxels]
+    else:
+        raise ValueError(f"Unknown mask_mode '{mask_mode}', expected 'brain' or 'lesion_union'.")
+
+    # Only the surviving voxels are expanded into feature columns
+    analysis_matrix = lesion_matrix.restrict(np.flatnonzero(analysis_voxels), masker, voxel_index)
+    print(f"{analysis_matrix.n_voxels}/{lesion_matrix.n_voxels} voxels kept as features")
+    lesion_data_prepared = analysis_matrix.to_sparse_features(dtype) if sparse else analysis_matrix.to_features(dtype)
 
-    sum_of_vectors_filtered = np.sum(lesion_data_prepared, axis=0)
-    sum_of_vectors_filtered = sum_of_vectors_filtered.astype(np.int32)  # Ensure integer type
-    sum_of_voxel_mni_filtered = masking.unmask(sum_of_vectors_filtered, masker)
+    sum_of_vectors_filtered = np.where(filtered_voxels, 0, voxel_patient_count).astype(np.int32)
+    sum_of_voxel_mni_filtered = lesion_matrix.unmask(sum_of_vectors_filtered)
     sum_of_vectors_filtered_path = output_folder / "lesion_overlap_filtered.nii.gz"
     nib.save(sum_of_voxel_mni_filtered, sum_of_vectors_filtered_path)
 
@@ -55,4 +74,4 @@ def filter_voxels_by_patient_count(lesion_files, min_patient_count, normalize_ve
         # Normalize the data to have unit norm
         lesion_data_prepared = normalize(lesion_data_prepared, norm='l2', axis=1)
 
-    return min_patient_count,lesion_data_prepared, masker
\ No newline at end of file
+    return min_patient_count,lesion_data_prepared, masker, voxel_index
\ No newline at end of file
@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_error
+from sklearn.model_selection import KFold
+from tqdm import tqdm
+
+from modules.epsilon_svr import fit_svr, full_dual
+from modules.kernel_engine import KernelEngine
+from modules.shared_array import create_shared_array, attach_shared_array, release_shared_array, resolve_n_jobs
+from modules.time_func import easy_time
+
+# Per-process state of the grid-search workers, set once by init_grid_worker
+worker_state = {}
+
+
+def fit_fold(kernel_engine, behaviors, C, gamma, epsilon, train_idx, test_idx, solver="libsvm", initial_dual=None, model="svr"):
+    """
+    Fit one (C, gamma, epsilon) SVR on a training fold and return its test MSE, number of support vectors
+    and dual vector (to warm-start the next C of the path with solver="smo").
+    """
+    svr = fit_svr(kernel_engine.train_kernel(gamma, train_idx), behaviors[train_idx], C, epsilon, solver, initial_dual, model)
+    predictions = svr.predict(kernel_engine.test_kernel(gamma, test_idx, train_idx))
+    return mean_squared_error(behaviors[test_idx], predictions), len(svr.support_), full_dual(svr, len(train_idx))
+
+
+def fit_c_path(kernel_engine, behaviors, C_values, gamma, epsilon, train_idx, test_idx, solver="libsvm", model="svr"):
+    """
+    Fit the C values of one (gamma, epsilon, fold) in order, each warm-started from the previous one's dual
+    with solver="smo". Returns the (mse, n_sv) of every C.
+    """
+    results = []
+    dual = None
+    for C in C_values:
+        score, n_sv, dual = fit_fold(kernel_engine, behaviors, C, gamma, epsilon, train_idx, test_idx, solver, dual, model)
+        results.append((score, n_sv))
+    return results
+
+
+def init_grid_worker(shm_name, shape, behaviors, solver, model):
+    worker_state['shm'], sq_distances = attach_shared_array(shm_name, shape, np.float64)
+    worker_state['kernel_engine'] = KernelEngine.from_sq_distances(sq_distances)
+    worker_state['behaviors'] = behaviors
+    worker_state['solver'] = solver
+    worker_state['model'] = model
+
+
+def fit_c_path_task(C_values, gamma, epsilon, train_idx, test_idx):
+    return fit_c_path(worker_state['kernel_engine'], worker_state['behaviors'], C_values, gamma, epsilon,
+                      train_idx, test_idx, worker_state['solver'], worker_state['model'])
+
+
+def run_parallel_grid(kernel_engine, behaviors, param_grid, folds, n_jobs, solver="libsvm", model="svr", cached=()):
+    """
+    Run the C path of every (gamma, epsilon, fold) on a process pool, and return the (mse, n_sv) of each (C, gamma, epsilon, fold).
+    Workers only need the patient x patient squared distances, which they read from shared memory.
+    (C, gamma, epsilon, fold) keys in cached are left out of the paths; paths left empty are not submitted.
+    """
+    shape = kernel_engine.sq_distances.shape
+    shm, shared_sq_distances = create_shared_array(shape, np.float64)
+    shared_sq_distances[...] = kernel_engine.sq_distances
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_grid_worker, initargs=(shm.name, shape, behaviors, solver, model)) as executor:
+            futures = {}
+            for gamma, epsilon in product(param_grid['gamma'], param_grid['epsilon']):
+                for fold, (train_idx, test_idx) in enumerate(folds):
+                    C_values = [C for C in param_grid['C'] if (C, gamma, epsilon, fold) not in cached]
+                    if C_values:
+                        futures[(gamma, epsilon, fold)] = (C_values, executor.submit(fit_c_path_task, C_values, gamma, epsilon, train_idx, test_idx))
+            fold_results = {}
+            for (gamma, epsilon, fold), (C_values, future) in tqdm(futures.items(), desc="Grid search", unit="C path", ncols=100):
+                for C, result in zip(C_values, future.result()):
+                    fold_results[(C, gamma, epsilon, fold)] = result
+    finally:
+        del shared_sq_distances
+        release_shared_array(shm)
+    return fold_results
+
+
+def grid_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, n_jobs=1, solver="libsvm", model="svr", cv_cache=None):
+    """
+    Grid search over param_grid with K-fold cross-validation, saving every combination's scores to results_and_scores.csv.
+    With n_jobs > 1 (or -1 for all cores) the C paths of the (gamma, epsilon, fold) triples run on a process pool;
+    the scores, and so the best parameters, are the same as in the serial search.
+    With solver="smo" each fit is warm-started from the dual of the previous C at the same (gamma, epsilon, fold).
+    model="kernel_ridge" scores LS-SVR fits instead, for which epsilon has no effect.
+    With a CVScoreCache, folds already scored by an earlier run on the same data are read from it instead of refitted,
+    and the new scores are added to it.
+    """
+    print("Performing grid search with K-fold cross-validation...")
+    cv = KFold(n_splits=n_splits, shuffle=True, random_state=42)
+    folds = list(cv.split(behaviors))
+
+    param_combinations = list(product(param_grid['C'], param_grid['gamma'], param_grid['epsilon']))
+
+    best_params = {'C': param_grid['C'][0], 'gamma': param_grid['gamma'][0], 'epsilon': param_grid['epsilon'][0]}
+
+    best_score = float('inf')
+    best_iteration = 1
+
+    patient_count = len(behaviors)
+    all_scores = []
+    num_iter = len(param_combinations)
+
+    n_jobs = resolve_n_jobs(n_jobs)
+    fold_results = None
+    if n_jobs > 1:
+        fold_results = {}
+        if cv_cache is not None:
+            for C, gamma, epsilon in param_combinations:
+                for fold, (train_idx, test_idx) in enumerate(folds):
+                    cached = cv_cache.get(C, gamma, epsilon, test_idx)
+                    if cached is not None:
+                        fold_results[(C, gamma, epsilon, fold)] = cached
+        new_results = {}
+        if len(fold_results) < num_iter * n_splits:
+            print(f"Running {num_iter * n_splits - len(fold_results)} fits on {n_jobs} workers...")
+            new_results = run_parallel_grid(kernel_engine, behaviors, param_grid, folds, n_jobs, solver, model, fold_results)
+        if cv_cache is not None:
+            for (C, gamma, epsilon, fold), (score, n_sv) in new_results.items():
+                cv_cache.put(C, gamma, epsilon, folds[fold][1], score, n_sv)
+            cv_cache.save()
+        fold_results.update(new_results)
+    # Dual of the last fitted C of each (gamma, epsilon, fold), to warm-start the next one
+    previous_duals = {}
+
+    # Iterate over all combinations of hyperparameters
+    for i, (C, gamma, epsilon) in enumerate(param_combinations, start=1):
+        print(f"\nIteration: i={i}/{num_iter}, Testing parameters: C={C}, gamma={gamma}, epsilon={epsilon}")
+        iter_time = time.time()
+
+        scores = []
+        no_of_sv = []
+
+        for split_ctr, (train_idx, test_idx) in enumerate(folds, start=1):
+            print(f"Split :{split_ctr}/{n_splits}")
+            cached = cv_cache.get(C, gamma, epsilon, test_idx) if cv_cache is not None and fold_results is None else None
+            if cached is not None:
+                score, n_sv = cached
+                print("\tfrom the CV score cache")
+            elif fold_results is None:
+                path_key = (gamma, epsilon, split_ctr)
+                score, n_sv, previous_duals[path_key] = fit_fold(kernel_engine, behaviors, C, gamma, epsilon, train_idx, test_idx,
+                                                                 solver, previous_duals.get(path_key), model)
+                if cv_cache is not None:
+                    cv_cache.put(C, gamma, epsilon, test_idx, score, n_sv)
+            else:
+                score, n_sv = fold_results[(C, gamma, epsilon, split_ctr - 1)]
+
+            print(f"\tno. of support vectors : {n_sv}/{patient_count}", )
+            no_of_sv.append(n_sv)
+
+            # default coef of determination metrics
+            print(f"\tscore : {score}", )
+
+            scores.append(score)
+
+        if cv_cache is not None:
+            cv_cache.save()
+
+        # Average score across all folds
+        avg_score = np.mean(scores)
+        avg_no_of_sv = np.mean(no_of_sv)
+
+        all_scores.append((i, C, gamma, epsilon, avg_score, scores, avg_no_of_sv, no_of_sv))
+
+        print(f"\nAverage score for mse: {avg_score:.4f}")
+        print(scores, "\n")
+
+        # Update best parameters if current score is better
+        if avg_score < best_score:
+            best_iteration = i
+            best_score = avg_score
+            best_params = {'C': C, 'gamma': gamma, 'epsilon': epsilon}
+
+        print(f"Best iteration: {best_iteration}, Best score: {best_score:.4f}->0, Current Score: {avg_score:.4f}")
+        print(f"Iteration {best_iteration} parameters: C = {best_params['C']}, gamma = {best_params['gamma']}, epsilon = {best_params['epsilon']}")
+
+        print(f"Iteration time: {easy_time(int(time.time() - iter_time))}")
+
+
+    columns = [
+        "Iteration", "C", "Gamma", "Epsilon", "Avg_Score", "Scores", "Avg_Support_Vectors", "Support_Vectors"
+    ]
+
+    df = pd.DataFrame(all_scores, columns=columns)
+    del all_scores
+
+    # Save to CSV
+    output_path = output_folder / 'results_and_scores.csv'
+    df.to_csv(output_path, index=False)
+    print(f"Results and scores saved to {output_path}")
+    del df
+
+    if cv_cache is not None:
+        print(f"{cv_cache.hits}/{num_iter * n_splits} fold scores read from the CV score cache")
+    print(f"Best parameters found: {best_params} with score {best_score:.4f} in iteration {best_iteration}/{num_iter}")
+    return best_params
\ No newline at end of file
@@ -0,0 +1,197 @@
+from itertools import product
+import math
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+
+from modules.grid_search import fit_fold
+from modules.time_func import easy_time
+
+# Successive halving keeps 1/HALVING_FACTOR of the configurations per round and multiplies their fold budget by it
+HALVING_FACTOR = 3
+
+# TPE: random trials before the sampler kicks in, share of trials modelled as "good", candidates drawn per trial
+TPE_STARTUP_TRIALS = 5
+TPE_GOOD_FRACTION = 0.25
+TPE_CANDIDATES = 24
+
+
+class Trial:
+    """
+    One (C, gamma, epsilon) configuration and its per-fold scores, evaluated fold by fold.
+    """
+
+    def __init__(self, number, C, gamma, epsilon):
+        self.number = number
+        self.C = C
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.scores = []
+        self.no_of_sv = []
+        self.pruned = False
+
+    @property
+    def avg_score(self):
+        return np.mean(self.scores) if self.scores else float('inf')
+
+    def evaluate(self, kernel_engine, behaviors, folds, n_folds, solver, model, cv_cache=None):
+        # Score the folds not yet evaluated, up to n_folds, reading them from the CV score cache when they are there
+        for train_idx, test_idx in folds[len(self.scores):n_folds]:
+            cached = cv_cache.get(self.C, self.gamma, self.epsilon, test_idx) if cv_cache is not None else None
+            if cached is not None:
+                score, n_sv = cached
+            else:
+                score, n_sv, _ = fit_fold(kernel_engine, behaviors, self.C, self.gamma, self.epsilon, train_idx, test_idx,
+                                          solver, model=model)
+                if cv_cache is not None:
+                    cv_cache.put(self.C, self.gamma, self.epsilon, test_idx, score, n_sv)
+            self.scores.append(score)
+            self.no_of_sv.append(n_sv)
+
+    def params(self):
+        return {'C': self.C, 'gamma': self.gamma, 'epsilon': self.epsilon}
+
+
+def save_trials(trials, output_folder):
+    columns = [
+        "Iteration", "C", "Gamma", "Epsilon", "Avg_Score", "Scores", "Avg_Support_Vectors", "Support_Vectors", "Pruned"
+    ]
+    df = pd.DataFrame([(t.number, t.C, t.gamma, t.epsilon, t.avg_score, t.scores, np.mean(t.no_of_sv), t.no_of_sv, t.pruned)
+                       for t in trials], columns=columns)
+    output_path = output_folder / 'results_and_scores.csv'
+    df.to_csv(output_path, index=False)
+    print(f"Results and scores saved to {output_path}")
+
+
+def successive_halving_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, solver="libsvm", model="svr", cv_cache=None):
+    """
+    Successive halving over the configurations of param_grid: every configuration is scored on one fold, the best
+    1/HALVING_FACTOR go on with HALVING_FACTOR times as many folds, and so on until the survivors have all n_splits folds.
+    Uses the same folds as grid_search and writes every trial (pruned ones with their partial scores) to results_and_scores.csv.
+    """
+    print("Performing successive-halving search with K-fold cross-validation...")
+    folds = list(KFold(n_splits=n_splits, shuffle=True, random_state=42).split(behaviors))
+    trials = [Trial(number, C, gamma, epsilon)
+              for number, (C, gamma, epsilon) in enumerate(product(param_grid['C'], param_grid['gamma'], param_grid['epsilon']), start=1)]
+
+    survivors = trials
+    n_folds = 1
+    while True:
+        round_time = time.time()
+        print(f"\n{len(survivors)} configurations on {n_folds}/{n_splits} folds")
+        for trial in survivors:
+            trial.evaluate(kernel_engine, behaviors, folds, n_folds, solver, model, cv_cache)
+            print(f"\tC={trial.C}, gamma={trial.gamma}, epsilon={trial.epsilon}: score {trial.avg_score:.4f}")
+        if cv_cache is not None:
+            cv_cache.save()
+        print(f"Round time: {easy_time(int(time.time() - round_time))}")
+        if n_folds == n_splits:
+            break
+        # Stable sort, so ties keep the grid order
+        survivors = sorted(survivors, key=lambda t: t.avg_score)
+        for trial in survivors[math.ceil(len(survivors) / HALVING_FACTOR):]:
+            trial.pruned = True
+        survivors = survivors[:math.ceil(len(survivors) / HALVING_FACTOR)]
+        n_folds = min(n_folds * HALVING_FACTOR, n_splits)
+
+    best = min(survivors, key=lambda t: t.avg_score)
+    save_trials(trials, output_folder)
+    n_fits = sum(len(t.scores) for t in trials)
+    print(f"Best parameters found: {best.params()} with score {best.avg_score:.4f} "
+          f"({n_fits} fits instead of {len(trials) * n_splits})")
+    return best.params()
+
+
+def parzen_log_density(values, centers, low, high):
+    """
+    Log density of a Parzen estimator on [low, high]: Gaussians at the centers plus a uniform prior component.
+    """
+    values = np.asarray(values)[:, None]
+    width = high - low
+    bandwidth = width * max(len(centers), 1) ** -0.2 / 2
+    gaussians = np.exp(-0.5 * ((values - np.asarray(centers)[None, :]) / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+    density = (gaussians.sum(axis=1) + 1 / width) / (len(centers) + 1)
+    return np.log(density)
+
+
+def tpe_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, solver="libsvm", model="svr", n_trials=20, seed=0, cv_cache=None):
+    """
+    Tree-structured Parzen estimator search over log C and log gamma, continuous between the smallest and largest values
+    of param_grid, and over param_grid's epsilon values.
+    After TPE_STARTUP_TRIALS random trials, each trial takes the candidate that maximises the density ratio of the best
+    TPE_GOOD_FRACTION trials over the others. A trial is pruned after a fold if its running score is worse than the median
+    of the earlier trials after the same number of folds.
+    Uses the same folds as grid_search and writes every trial to results_and_scores.csv.
+    """
+    print("Performing TPE search with K-fold cross-validation...")
+    folds = list(KFold(n_splits=n_splits, shuffle=True, random_state=42).split(behaviors))
+    rng = np.random.default_rng(seed)
+    log_ranges = {'C': (np.log(min(param_grid['C'])), np.log(max(param_grid['C']))),
+                  'gamma': (np.log(min(param_grid['gamma'])), np.log(max(param_grid['gamma'])))}
+    epsilons = list(param_grid['epsilon'])
+
+    trials = []
+    best_score = float('inf')
+    best_params = None
+    for number in range(1, n_trials + 1):
+        trial_time = time.time()
+        params = {}
+        if number <= TPE_STARTUP_TRIALS:
+            for name, (low, high) in log_ranges.items():
+                params[name] = float(f"{np.exp(rng.uniform(low, high)):.6g}")
+            params['epsilon'] = epsilons[rng.integers(len(epsilons))]
+        else:
+            ranked = sorted(trials, key=lambda t: t.avg_score)
+            n_good = max(1, int(np.ceil(TPE_GOOD_FRACTION * len(ranked))))
+            good, bad = ranked[:n_good], ranked[n_good:]
+            ratio = np.zeros(TPE_CANDIDATES)
+            candidates = {}
+            for name, (low, high) in log_ranges.items():
+                if high == low:
+                    candidates[name] = np.full(TPE_CANDIDATES, low)
+                    continue
+                good_centers = [np.log(getattr(t, name)) for t in good]
+                # Candidates drawn from the "good" estimator: a center plus Gaussian noise, clipped to the range
+                picks = rng.choice(good_centers, size=TPE_CANDIDATES)
+                bandwidth = (high - low) * len(good_centers) ** -0.2 / 2
+                candidates[name] = np.clip(picks + rng.normal(0, bandwidth, TPE_CANDIDATES), low, high)
+                ratio += parzen_log_density(candidates[name], good_centers, low, high)
+                ratio -= parzen_log_density(candidates[name], [np.log(getattr(t, name)) for t in bad], low, high)
+            # Epsilon: categorical estimator with one prior count per value
+            good_counts = np.array([sum(t.epsilon == e for t in good) + 1 for e in epsilons], dtype=float)
+            bad_counts = np.array([sum(t.epsilon == e for t in bad) + 1 for e in epsilons], dtype=float)
+            epsilon_picks = rng.choice(len(epsilons), size=TPE_CANDIDATES, p=good_counts / good_counts.sum())
+            ratio += np.log(good_counts[epsilon_picks] / good_counts.sum()) - np.log(bad_counts[epsilon_picks] / bad_counts.sum())
+            chosen = int(np.argmax(ratio))
+            params = {name: float(f"{np.exp(values[chosen]):.6g}") for name, values in candidates.items()}
+            params['epsilon'] = epsilons[epsilon_picks[chosen]]
+
+        trial = Trial(number, params['C'], params['gamma'], params['epsilon'])
+        print(f"\nTrial: {number}/{n_trials}, Testing parameters: C={trial.C:.4g}, gamma={trial.gamma:.4g}, epsilon={trial.epsilon}")
+        for n_folds in range(1, n_splits + 1):
+            trial.evaluate(kernel_engine, behaviors, folds, n_folds, solver, model, cv_cache)
+            # Median pruning against the running scores of the earlier trials after as many folds
+            earlier = [np.mean(t.scores[:n_folds]) for t in trials if len(t.scores) >= n_folds]
+            if n_folds < n_splits and number > TPE_STARTUP_TRIALS and earlier and trial.avg_score > np.median(earlier):
+                trial.pruned = True
+                print(f"\tPruned after {n_folds}/{n_splits} folds, score {trial.avg_score:.4f}")
+                break
+        trials.append(trial)
+        if cv_cache is not None:
+            cv_cache.save()
+        # Continuous gammas would otherwise keep one cached kernel per trial
+        kernel_engine.kernels.pop(trial.gamma, None)
+
+        if not trial.pruned:
+            print(f"\tscore : {trial.avg_score:.4f}")
+            if trial.avg_score < best_score:
+                best_score = trial.avg_score
+                best_params = trial.params()
+        print(f"Trial time: {easy_time(int(time.time() - trial_time))}")
+
+    save_trials(trials, output_folder)
+    n_fits = sum(len(t.scores) for t in trials)
+    print(f"Best parameters found: {best_params} with score {best_score:.4f} ({n_fits} fits over {n_trials} trials)")
+    return best_params
\ No newline at end of file
@@ -0,0 +1,178 @@
+import json
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing.connection import wait
+from pathlib import Path
+
+import numpy as np
+from pandas import read_csv
+
+from modules.checkpoint import write_json, RUN_CONFIG_NAME
+from modules.lesion_matrix import prepare_mask
+from modules.permutation_test import PERMUTATION_CHUNK_SIZE
+from modules.run_svr_lsm_iteration import run_svr_lsm_iteration
+from modules.shared_array import resolve_n_jobs
+from modules.time_func import easy_time, get_current_datetime_for_filename
+
+# Memory of one Python process with numpy, scipy, sklearn and nilearn loaded, before any data
+PROCESS_BASE_BYTES = 300 << 20
+
+# Job keys read by the scheduler rather than passed to run_svr_lsm_iteration (it passes output_folder or resume itself)
+SCHEDULER_KEYS = ('name', 'memory_gb', 'output_folder')
+
+# Mask voxel count of every first lesion file, as jobs of one symptom folder share it
+mask_voxel_counts = {}
+
+
+def job_name(job, number):
+    return job.get('name', f"job{number:03d}")
+
+
+def mask_voxel_count(symptom_folder, csv_name):
+    # Voxels of the brain mask run_svr_lsm_iteration will use, i.e. that of the first lesion
+    first_file = Path(symptom_folder) / 'data' / read_csv(Path(symptom_folder) / csv_name)['filename'].iloc[0]
+    if first_file not in mask_voxel_counts:
+        _, mask, _ = prepare_mask(first_file)
+        mask_voxel_counts[first_file] = int(np.count_nonzero(mask))
+    return mask_voxel_counts[first_file]
+
+
+def estimate_job_memory(job):
+    """
+    Rough peak memory, in bytes, of a run_svr_lsm_iteration job from its cohort size and mask voxel count:
+    the lesion matrix, the features and one copy of them (shared memory or the pattern deduplication), the per-voxel
+    null accumulators, every worker's chunk of float64 maps and the patient x patient kernels of the grid.
+    Filtering and deduplication only shrink the features, so this is an upper bound in practice.
+    A job's 'memory_gb' overrides it.
+    """
+    if 'memory_gb' in job:
+        return int(job['memory_gb'] * (1 << 30))
+    n_patients = len(read_csv(Path(job['symptom_folder']) / job['csv_name']))
+    n_voxels = mask_voxel_count(job['symptom_folder'], job['csv_name'])
+    n_workers = resolve_n_jobs(job.get('n_jobs', 1))
+    itemsize = np.dtype(job.get('dtype', "float32")).itemsize
+    lesion_bytes = n_patients * n_voxels // (8 if job.get('packed', False) else 1)
+    feature_bytes = 2 * n_patients * n_voxels * itemsize
+    null_bytes = 6 * n_voxels * 8
+    map_bytes = n_workers * 3 * PERMUTATION_CHUNK_SIZE * n_voxels * 8
+    kernel_bytes = (len(job['param_grid']['gamma']) + 2) * n_patients ** 2 * 8
+    return lesion_bytes + feature_bytes + null_bytes + map_bytes + kernel_bytes + (n_workers + 1) * PROCESS_BASE_BYTES
+
+
+def total_memory_bytes():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def read_queue_state(state_file):
+    if not state_file.exists():
+        return {'jobs': {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+def run_job(job, output_folder, log_path):
+    # Child process of one job: its output, and that of its worker processes, goes to its own log file
+    with open(log_path, 'a') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        arguments = {key: value for key, value in job.items() if key not in SCHEDULER_KEYS}
+        arguments['symptom_folder'] = Path(arguments['symptom_folder'])
+        if (output_folder / RUN_CONFIG_NAME).exists():
+            # Started before: continue from its checkpoint (a run interrupted before its first checkpoint starts over)
+            run_svr_lsm_iteration(**arguments, resume=output_folder)
+        else:
+            run_svr_lsm_iteration(**arguments, output_folder=output_folder)
+
+
+def run_job_queue(job_file, max_cores=None, max_memory_gb=None, state_file=None, retry_failed=False):
+    """
+    Run the run_svr_lsm_iteration jobs of a JSON job file (a list of their keyword arguments, each with an optional
+    unique 'name', 'memory_gb' and 'output_folder') concurrently, each in its own process, within a budget of
+    max_cores cores (all by default; a job takes its n_jobs) and max_memory_gb of RAM (80% of the machine's by default;
+    a job takes estimate_job_memory). Jobs start in file order, later ones filling the budget left by earlier ones that do not fit;
+    a job larger than the whole budget runs alone.
+
+    The queue state (every job's status, output folder and exit code) is kept in state_file, by default
+    <job_file>.state.json. Run again after an interruption, the queue skips the finished jobs and resumes the
+    interrupted ones from their checkpoints; failed jobs are only rerun with retry_failed=True.
+    Every job's output is logged to job.log in its output folder, by default
+    outputs/<name>_<n_permutations>_results_<datetime>.
+    """
+    job_file = Path(job_file)
+    state_file = Path(state_file) if state_file is not None else job_file.with_name(f"{job_file.stem}.state.json")
+    with open(job_file) as f:
+        job_list = json.load(f)
+    jobs = {job_name(job, number): job for number, job in enumerate(job_list, start=1)}
+    if len(jobs) != len(job_list):
+        raise ValueError(f"The jobs of {job_file} need unique names.")
+    for name, job in jobs.items():
+        if 'resume' in job:
+            raise ValueError(f"Job {name} of {job_file} sets 'resume': the queue resumes interrupted jobs itself, "
+                             f"give the folder to resume as its 'output_folder' instead.")
+    max_cores = resolve_n_jobs(max_cores)
+    max_memory = total_memory_bytes() * 0.8 if max_memory_gb is None else max_memory_gb * (1 << 30)
+
+    state = read_queue_state(state_file)
+    pending = []
+    for name, job in jobs.items():
+        job_state = state['jobs'].setdefault(name, {'status': "pending"})
+        if job_state['status'] == "done" or (job_state['status'] == "failed" and not retry_failed):
+            print(f"{name}: {job_state['status']}, skipped")
+            continue
+        pending.append(name)
+    write_json(state_file, state)
+
+    requirements = {name: (min(resolve_n_jobs(jobs[name].get('n_jobs', 1)), max_cores), estimate_job_memory(jobs[name])) for name in pending}
+    print(f"{len(pending)} jobs to run within {max_cores} cores and {max_memory / (1 << 30):.1f} GB")
+
+    running = {}
+    queue_time = time.time()
+    while pending or running:
+        used_cores = sum(requirements[name][0] for name in running)
+        used_memory = sum(requirements[name][1] for name in running)
+        for name in list(pending):
+            cores, memory = requirements[name]
+            if running and (used_cores + cores > max_cores or used_memory + memory > max_memory):
+                continue
+            job_state = state['jobs'][name]
+            if 'output_folder' not in job_state:
+                job_state['output_folder'] = str(jobs[name].get('output_folder', f"outputs/{name}_{jobs[name]['n_permutations']}_results_{get_current_datetime_for_filename()}"))
+            output_folder = Path(job_state['output_folder'])
+            output_folder.mkdir(parents=True, exist_ok=True)
+            process = multiprocessing.Process(target=run_job, args=(jobs[name], output_folder, output_folder / "job.log"))
+            process.start()
+            job_state['status'] = "running"
+            write_json(state_file, state)
+            running[name] = process
+            pending.remove(name)
+            used_cores += cores
+            used_memory += memory
+            print(f"Started {name} ({cores} cores, ~{memory / (1 << 30):.1f} GB) in {output_folder}: "
+                  f"{len(running)} running, {len(pending)} pending")
+
+        try:
+            wait([process.sentinel for process in running.values()])
+        except KeyboardInterrupt:
+            # The jobs get the Ctrl-C too and checkpoint themselves; their state stays "running", to be resumed
+            for process in running.values():
+                process.join()
+            write_json(state_file, state)
+            print(f"\nQueue interrupted; run it again to resume the {len(running)} running and {len(pending)} pending jobs")
+            raise
+        for name, process in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            job_state = state['jobs'][name]
+            job_state['status'] = "done" if process.exitcode == 0 else "failed"
+            job_state['exitcode'] = process.exitcode
+            write_json(state_file, state)
+            del running[name]
+            print(f"{name} {job_state['status']} (exit code {process.exitcode}) after {easy_time(int(time.time() - queue_time))}")
+
+    print("Queue finished: " + ", ".join(f"{status} {sum(s['status'] == status for s in state['jobs'].values())}"
+                                         for status in ("done", "failed")))
\ No newline at end of file
@@ -0,0 +1,60 @@
+import numpy as np
+from scipy import sparse
+
+
+def squared_distances(features, block_size=8192, weights=None):
+    """
+    Patient x patient squared Euclidean distances. Every block of voxel columns is multiplied in the features' dtype
+    (float32 features are never copied to float64) and accumulated in float64.
+    With weights, column v counts weights[v] times, e.g. the number of voxels sharing a unique lesion pattern.
+    """
+    n_patients = features.shape[0]
+    if sparse.issparse(features):
+        # Sparse products already only touch the lesioned voxels
+        weighted = features if weights is None else features.multiply(np.asarray(weights, dtype=features.dtype)[None, :]).tocsr()
+        gram = (weighted @ features.T).toarray().astype(np.float64)
+    else:
+        gram = np.zeros((n_patients, n_patients), dtype=np.float64)
+        for start in range(0, features.shape[1], block_size):
+            block = features[:, start:start + block_size]
+            if weights is None:
+                gram += block @ block.T
+            else:
+                gram += (block * weights[start:start + block_size].astype(block.dtype)) @ block.T
+    norms = np.diag(gram)
+    distances = norms[:, None] + norms[None, :] - 2 * gram
+    np.maximum(distances, 0, out=distances)
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+class KernelEngine:
+    """
+    RBF kernels of one set of patients, shared by the grid search, the final fit and the permutations.
+    The squared-distance matrix is computed once; each gamma's kernel is an elementwise exp of it.
+    """
+
+    def __init__(self, features, block_size=8192, weights=None):
+        print("Computing patient x patient squared distances...")
+        self.sq_distances = squared_distances(features, block_size, weights)
+        self.kernels = {}
+
+    @classmethod
+    def from_sq_distances(cls, sq_distances):
+        # Engine over an already computed squared-distance matrix, e.g. one shared with worker processes
+        kernel_engine = cls.__new__(cls)
+        kernel_engine.sq_distances = sq_distances
+        kernel_engine.kernels = {}
+        return kernel_engine
+
+    def kernel(self, gamma):
+        if gamma not in self.kernels:
+            self.kernels[gamma] = np.exp(-gamma * self.sq_distances)
+        return self.kernels[gamma]
+
+    def train_kernel(self, gamma, train_idx):
+        return self.kernel(gamma)[np.ix_(train_idx, train_idx)]
+
+    def test_kernel(self, gamma, test_idx, train_idx):
+        # Rows are the test patients, columns the training patients, as SVR(kernel='precomputed') expects
+        return self.kernel(gamma)[np.ix_(test_idx, train_idx)]
\ No newline at end of file
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+def ls_svr_operator(kernel, C):
+    """
+    Least-squares SVR (kernel ridge with a bias) on a precomputed kernel, as linear maps of the targets.
+
+    The LS-SVR solves K a + a / C + b = y with sum(a) = 0. With H = (K + I / C)^-1 from one eigendecomposition of K,
+    the solution is a = dual_operator @ y and b = bias_weights @ y, for one target vector or an (n x targets) block.
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    eigenvalues, eigenvectors = np.linalg.eigh(kernel)
+    inverse = (eigenvectors / (eigenvalues + 1 / C)) @ eigenvectors.T
+    inverse_ones = inverse.sum(axis=1)
+    bias_weights = inverse_ones / inverse_ones.sum()
+    dual_operator = inverse - np.outer(inverse_ones, bias_weights)
+    return dual_operator, bias_weights
+
+
+class LeastSquaresSVR:
+    """
+    LS-SVR on a precomputed kernel, with the attributes of sklearn's SVR (support_, dual_coef_, intercept_).
+    Every training patient has a dual coefficient, so support_ covers all of them.
+    """
+
+    def __init__(self, C=1.0):
+        self.C = C
+
+    def fit(self, kernel, y):
+        dual_operator, bias_weights = ls_svr_operator(kernel, self.C)
+        y = np.asarray(y, dtype=np.float64)
+        self.support_ = np.arange(len(y))
+        self.dual_coef_ = (dual_operator @ y).reshape(1, -1)
+        self.intercept_ = np.array([bias_weights @ y])
+        return self
+
+    def predict(self, kernel):
+        # kernel: (test patients x training patients)
+        return np.asarray(kernel, dtype=np.float64) @ self.dual_coef_[0] + self.intercept_[0]
\ No newline at end of file
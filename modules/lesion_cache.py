@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from modules.lesion_matrix import LesionMatrix, decode_lesions, prepare_mask
+
+MANIFEST_NAME = "manifest.json"
+MASK_NAME = "mask.nii.gz"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mask_hash(mask_img):
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    digest = hashlib.sha1()
+    digest.update(str(mask.shape).encode())
+    digest.update(np.asarray(mask_img.affine, dtype=np.float64).tobytes())
+    digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def grid_hash(img):
+    digest = hashlib.sha1()
+    digest.update(str(img.shape[:3]).encode())
+    digest.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def read_manifest(cache_folder):
+    manifest_path = cache_folder / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def check_manifest(cache_folder, manifest, expected_mask_hash):
+    if manifest is None:
+        return None
+    if manifest['mask_hash'] != expected_mask_hash:
+        print("Lesion cache was built with a different mask, rebuilding it")
+        return None
+    if not (cache_folder / manifest['matrix_file']).exists():
+        print("Lesion cache matrix is missing, rebuilding it")
+        return None
+    return manifest
+
+
+def write_manifest(cache_folder, manifest):
+    # Written to a temporary file first, so a reader never sees a half-written manifest
+    tmp_path = cache_folder / f"{MANIFEST_NAME}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, cache_folder / MANIFEST_NAME)
+
+
+def append_rows(cache_folder, manifest, new_data):
+    """
+    Write a new matrix file holding the cached rows followed by new_data, and return its file name.
+    The previous matrix stays valid until the manifest is replaced.
+    """
+    n_cached = len(manifest['entries'])
+    matrix_file = f"lesion_matrix_{uuid.uuid4().hex}.npy"
+    shape = (n_cached + len(new_data), new_data.shape[1])
+    matrix = np.lib.format.open_memmap(cache_folder / matrix_file, mode='w+', dtype=np.uint8, shape=shape)
+    if n_cached:
+        matrix[:n_cached] = np.load(cache_folder / manifest['matrix_file'], mmap_mode='r')
+    matrix[n_cached:] = new_data
+    matrix.flush()
+    del matrix
+    return matrix_file
+
+
+def load_cached_lesion_matrix(lesion_files, cache_folder, mask_img=None, n_jobs=1, packed=False):
+    """
+    Load a LesionMatrix through an on-disk cache of decoded lesions.
+
+    The cache folder holds the masked uint8 lesion matrix (.npy), the mask and a manifest.
+    Rows are keyed by the content hash of each lesion file, and the whole cache by the hash of the mask.
+    Only new or changed files are decoded and appended; the matrix itself is opened with mmap.
+    With packed=True the cached rows are bit-packed in memory into a PackedLesionMatrix.
+    """
+    cache_folder = Path(cache_folder)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+
+    manifest = read_manifest(cache_folder)
+    lesion_grid_hash = grid_hash(nib.load(lesion_files[0]))
+    if mask_img is None and manifest is not None and manifest.get('grid_hash') == lesion_grid_hash:
+        # The default brain mask only depends on the lesion grid, so the cached one can be reused
+        mask_img = nib.load(cache_folder / MASK_NAME)
+    mask_img, mask, voxel_volume = prepare_mask(lesion_files[0], mask_img)
+    current_mask_hash = mask_hash(mask_img)
+
+    print(f"Hashing {len(lesion_files)} lesion files for the lesion cache in {cache_folder}...")
+    hashes = [file_hash(f) for f in lesion_files]
+
+    manifest = check_manifest(cache_folder, manifest, current_mask_hash)
+    if manifest is None:
+        manifest = {'mask_hash': current_mask_hash, 'grid_hash': lesion_grid_hash, 'matrix_file': None, 'entries': [], 'files': {}}
+        nib.save(mask_img, cache_folder / MASK_NAME)
+    row_of_hash = {entry['hash']: row for row, entry in enumerate(manifest['entries'])}
+
+    # Decode each missing content hash once, even if several files share it
+    missing = {}
+    for file, file_digest in zip(lesion_files, hashes):
+        if file_digest not in row_of_hash:
+            missing.setdefault(file_digest, file)
+    print(f"{len(lesion_files) - len(missing)} lesions found in cache, {len(missing)} to decode")
+
+    files_changed = any(manifest['files'].get(os.path.abspath(f)) != h for f, h in zip(lesion_files, hashes))
+    if missing:
+        new_data, new_counts = decode_lesions(list(missing.values()), mask, n_jobs)
+        old_matrix_file = manifest['matrix_file']
+        manifest['matrix_file'] = append_rows(cache_folder, manifest, new_data)
+        for file_digest, count in zip(missing, new_counts):
+            row_of_hash[file_digest] = len(manifest['entries'])
+            manifest['entries'].append({'hash': file_digest, 'lesion_voxel_count': int(count)})
+        del new_data
+    if missing or files_changed:
+        manifest['files'].update({os.path.abspath(f): h for f, h in zip(lesion_files, hashes)})
+        write_manifest(cache_folder, manifest)
+        if missing and old_matrix_file is not None:
+            try:
+                os.remove(cache_folder / old_matrix_file)
+            except OSError:
+                # Still mapped by another process (Windows); it is only wasted disk space
+                pass
+
+    data = np.load(cache_folder / manifest['matrix_file'], mmap_mode='r')
+    rows = np.array([row_of_hash[h] for h in hashes], dtype=np.int64)
+    if len(rows) != len(data) or np.any(rows != np.arange(len(data))):
+        # The cohort is a subset or reordering of the cache: gather its rows
+        data = data[rows]
+    lesion_voxel_counts = np.array([manifest['entries'][row]['lesion_voxel_count'] for row in rows], dtype=np.int64)
+
+    lesion_matrix = LesionMatrix(lesion_files, data, mask_img, lesion_voxel_counts, voxel_volume)
+    if packed:
+        return lesion_matrix.pack()
+    return lesion_matrix
\ No newline at end of file
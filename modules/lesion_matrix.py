@@ -0,0 +1,239 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+from nilearn import masking
+from scipy import sparse
+
+from modules.fast_unmask import fast_unmask, mask_voxel_index
+from modules.shared_array import create_shared_array, attach_shared_array, release_shared_array, resolve_n_jobs
+
+# Per-process state of the decoding workers, set once by init_decode_worker
+worker_state = {}
+
+
+class LesionMatrix:
+    """
+    Binary lesion data of a cohort, decoded once into a (patients x masked voxels) uint8 matrix.
+    """
+
+    def __init__(self, lesion_files, data, mask_img, lesion_voxel_counts, voxel_volume, voxel_index=None):
+        self.lesion_files = list(lesion_files)
+        self.data = data
+        self.mask_img = mask_img
+        self.lesion_voxel_counts = lesion_voxel_counts
+        self.voxel_volume = voxel_volume
+        # Flat grid index of every column, mask_img's own voxels unless the matrix was restricted
+        self.voxel_index = mask_voxel_index(mask_img) if voxel_index is None else voxel_index
+
+    @property
+    def n_patients(self):
+        return self.data.shape[0]
+
+    @property
+    def n_voxels(self):
+        return self.data.shape[1]
+
+    def voxel_patient_count(self):
+        # Number of patients lesioned at each masked voxel
+        return self.data.sum(axis=0, dtype=np.int32)
+
+    def lesion_volumes(self):
+        # Whole-image lesion volume of every patient, in mm^3, as a column vector
+        return (self.lesion_voxel_counts * self.voxel_volume).reshape(-1, 1)
+
+    def rows(self, patients, dtype=np.float32):
+        return self.data[patients].astype(dtype)
+
+    def to_features(self, dtype=np.float32):
+        return self.data.astype(dtype)
+
+    def to_sparse_features(self, dtype=np.float32):
+        # CSR features built 8 patients at a time, so memory scales with the lesioned voxels only
+        blocks = [sparse.csr_matrix(self.rows(np.arange(start, min(start + 8, self.n_patients)), dtype))
+                  for start in range(0, self.n_patients, 8)]
+        return sparse.vstack(blocks, format='csr')
+
+    def unmask(self, vector):
+        return fast_unmask(vector, self.voxel_index, self.mask_img)
+
+    def restrict(self, columns, mask_img, voxel_index):
+        # The same patients on a subset of the voxels, placed in mask_img's grid by voxel_index
+        return LesionMatrix(self.lesion_files, self.data[:, columns], mask_img, self.lesion_voxel_counts, self.voxel_volume, voxel_index)
+
+    def pack(self):
+        """
+        Bit-pack the matrix along the patient axis, 8 patients at a time so a memory-mapped matrix is never fully read in.
+        """
+        packed = np.zeros((-(-self.n_patients // 8), self.n_voxels), dtype=np.uint8)
+        for row in range(packed.shape[0]):
+            packed[row] = np.packbits(self.data[row * 8:(row + 1) * 8], axis=0)
+        return PackedLesionMatrix(self.lesion_files, packed, self.mask_img, self.lesion_voxel_counts, self.voxel_volume, self.voxel_index)
+
+
+class PackedLesionMatrix(LesionMatrix):
+    """
+    LesionMatrix bit-packed along the patient axis: byte row r holds patients 8r..8r+7 (first patient in the high bit),
+    which takes 8x less memory than uint8 and 64x less than float64.
+    Patient counts are popcounts over the byte rows; rows are only expanded to dense values for the features.
+    """
+
+    def __init__(self, lesion_files, packed, mask_img, lesion_voxel_counts, voxel_volume, voxel_index=None):
+        super().__init__(lesion_files, None, mask_img, lesion_voxel_counts, voxel_volume, voxel_index)
+        self.packed = packed
+
+    @property
+    def n_patients(self):
+        return len(self.lesion_files)
+
+    @property
+    def n_voxels(self):
+        return self.packed.shape[1]
+
+    def voxel_patient_count(self):
+        counts = np.zeros(self.n_voxels, dtype=np.int32)
+        for byte_row in self.packed:
+            counts += np.bitwise_count(byte_row)
+        return counts
+
+    def rows(self, patients, dtype=np.float32):
+        # Expand only the requested patients to dense values
+        patients = np.asarray(patients)
+        bits = (self.packed[patients // 8] >> (7 - patients % 8)[:, None]) & 1
+        return bits.astype(dtype)
+
+    def to_features(self, dtype=np.float32):
+        features = np.empty((self.n_patients, self.n_voxels), dtype=dtype)
+        for row in range(self.packed.shape[0]):
+            block = np.unpackbits(self.packed[row:row + 1], axis=0, count=min(8, self.n_patients - row * 8))
+            features[row * 8:row * 8 + len(block)] = block
+        return features
+
+    def restrict(self, columns, mask_img, voxel_index):
+        return PackedLesionMatrix(self.lesion_files, self.packed[:, columns], mask_img, self.lesion_voxel_counts, self.voxel_volume, voxel_index)
+
+    def pack(self):
+        return self
+
+
+def decode_lesion(file, mask):
+    """
+    Decode one lesion file into the uint8 row of its masked voxels and its whole-image lesioned voxel count.
+    Voxels > 0 are lesioned; also returns whether the file was binary (only 0 and 1), as other values are lost.
+    """
+    lesion_img = nib.load(file)
+    if lesion_img.shape[:3] != mask.shape:
+        raise ValueError(f"Lesion {file} has shape {lesion_img.shape}, expected {mask.shape}.")
+    values = np.asanyarray(lesion_img.dataobj)
+    lesion_data = values > 0
+    binary = bool(np.all((values == 0) | (values == 1)))
+    return lesion_data[mask].view(np.uint8), np.count_nonzero(lesion_data), binary
+
+
+def decode_group(files, mask, packed):
+    """
+    Decode consecutive lesion files into stored rows: one uint8 row per file, or a single
+    bit-packed row holding up to 8 patients when packed.
+    """
+    rows, counts, binary = zip(*(decode_lesion(file, mask) for file in files))
+    block = np.vstack(rows)
+    if packed:
+        block = np.packbits(block, axis=0)
+    return block, np.array(counts, dtype=np.int64), [file for file, is_binary in zip(files, binary) if not is_binary]
+
+
+def init_decode_worker(mask, packed, shm_name, shape):
+    worker_state['mask'] = mask
+    worker_state['packed'] = packed
+    worker_state['shm'], worker_state['data'] = attach_shared_array(shm_name, shape, np.uint8)
+
+
+def decode_shard(rows, files):
+    """
+    Decode a shard of lesion files straight into their rows of the shared lesion matrix.
+    Only the lesioned voxel counts and the non-binary files are sent back to the parent.
+    """
+    group_size = 8 if worker_state['packed'] else 1
+    lesion_voxel_counts = []
+    non_binary_files = []
+    for i, row in enumerate(rows):
+        group_files = files[i * group_size:(i + 1) * group_size]
+        worker_state['data'][row], counts, non_binary = decode_group(group_files, worker_state['mask'], worker_state['packed'])
+        lesion_voxel_counts.append(counts)
+        non_binary_files += non_binary
+    return rows, np.concatenate(lesion_voxel_counts), non_binary_files
+
+
+def decode_parallel(lesion_files, mask, shape, packed, n_jobs):
+    group_size = 8 if packed else 1
+    shm, shared_data = create_shared_array(shape, np.uint8)
+    lesion_voxel_counts = np.zeros(len(lesion_files), dtype=np.int64)
+    non_binary_files = []
+    try:
+        # Several small shards per worker keep the load balanced when file sizes differ
+        shards = np.array_split(np.arange(shape[0]), min(shape[0], n_jobs * 4))
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_decode_worker, initargs=(mask, packed, shm.name, shape)) as executor:
+            futures = [executor.submit(decode_shard, rows, lesion_files[rows[0] * group_size:(rows[-1] + 1) * group_size]) for rows in shards]
+            for future in futures:
+                rows, counts, non_binary = future.result()
+                lesion_voxel_counts[rows[0] * group_size:rows[0] * group_size + len(counts)] = counts
+                non_binary_files += non_binary
+        data = shared_data.copy()
+    finally:
+        del shared_data
+        release_shared_array(shm)
+    return data, lesion_voxel_counts, non_binary_files
+
+
+def decode_lesions(lesion_files, mask, n_jobs=1, packed=False):
+    """
+    Decode lesion files into the uint8 matrix of their masked voxels, plus their whole-image lesioned voxel counts.
+    With packed=True the matrix is bit-packed along the patient axis as it is decoded (see PackedLesionMatrix).
+    With n_jobs > 1 (or -1 for all cores) the files are decoded by a process pool.
+    Lesions are binarized at > 0: files with other values than 0 and 1 (e.g. interpolated after normalisation)
+    are listed in a warning, as their features and overlap no longer follow their raw values.
+    """
+    group_size = 8 if packed else 1
+    shape = (-(-len(lesion_files) // group_size), int(mask.sum()))
+    n_jobs = min(resolve_n_jobs(n_jobs), shape[0])
+    print(f"Decoding {len(lesion_files)} lesion files with {n_jobs} worker(s)...")
+    if n_jobs > 1:
+        data, lesion_voxel_counts, non_binary_files = decode_parallel(lesion_files, mask, shape, packed, n_jobs)
+    else:
+        data = np.zeros(shape, dtype=np.uint8)
+        lesion_voxel_counts = np.zeros(len(lesion_files), dtype=np.int64)
+        non_binary_files = []
+        for row in range(shape[0]):
+            first = row * group_size
+            data[row], lesion_voxel_counts[first:first + group_size], non_binary = decode_group(lesion_files[first:first + group_size], mask, packed)
+            non_binary_files += non_binary
+    if non_binary_files:
+        print(f"Warning: {len(non_binary_files)} lesion files are not binary and were binarized at > 0 "
+              f"(threshold them first to choose the cut-off): " + ", ".join(str(file) for file in non_binary_files[:5])
+              + (", ..." if len(non_binary_files) > 5 else ""))
+    return data, lesion_voxel_counts
+
+
+def prepare_mask(first_file, mask_img=None):
+    """
+    Return the analysis mask image, its boolean data and the voxel volume of the lesion grid.
+    If no mask is given, the brain mask of the first lesion is used.
+    """
+    first_img = nib.load(first_file)
+    if mask_img is None:
+        mask_img = masking.compute_brain_mask(first_img)
+    mask = np.asanyarray(mask_img.dataobj) > 0
+    voxel_volume = float(np.prod(first_img.header.get_zooms()[:3]))
+    return mask_img, mask, voxel_volume
+
+
+def load_lesion_matrix(lesion_files, mask_img=None, n_jobs=1, packed=False):
+    """
+    Decode every lesion file exactly once into a LesionMatrix, or a PackedLesionMatrix when packed=True.
+    If no mask is given, the brain mask of the first lesion is used.
+    """
+    mask_img, mask, voxel_volume = prepare_mask(lesion_files[0], mask_img)
+    data, lesion_voxel_counts = decode_lesions(lesion_files, mask, n_jobs, packed)
+    if packed:
+        return PackedLesionMatrix(lesion_files, data, mask_img, lesion_voxel_counts, voxel_volume)
+    return LesionMatrix(lesion_files, data, mask_img, lesion_voxel_counts, voxel_volume)
\ No newline at end of file
@@ -1,13 +1,39 @@
 from sklearn.preprocessing import StandardScaler
 from pandas import read_csv
 import numpy as np
-import nibabel as nib
 import os
-def load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_out_lesion_volume=False):
+
+from modules.lesion_matrix import load_lesion_matrix
+from modules.lesion_cache import load_cached_lesion_matrix
+def load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_out_lesion_volume=False, n_jobs=1, cache_folder=None, packed=False):
     """
     Load lesion files, behavioral data, and covariates from CSV, and compute lesion volumes.
+    Every lesion file is decoded once into a LesionMatrix, which is returned for the later steps.
+    With a cache_folder, previously decoded lesions are reused from the on-disk lesion cache.
+    With packed=True the lesions are kept bit-packed (see PackedLesionMatrix).
     """
     print("Loading behavioral data and lesion files...")
+    lesion_files, behaviors, csv_covariates = load_behaviors(lesion_folder, csv_file, max_score)
+
+    if cache_folder is not None:
+        lesion_matrix = load_cached_lesion_matrix(lesion_files, cache_folder, n_jobs=n_jobs, packed=packed)
+    else:
+        lesion_matrix = load_lesion_matrix(lesion_files, n_jobs=n_jobs, packed=packed)
+
+    # Compute lesion volumes
+
+    print("\nComputing lesion volumes...")
+    lesion_volumes = lesion_matrix.lesion_volumes()
+
+    covariates = prepare_covariates(csv_covariates, lesion_volumes, do_regress_out_lesion_volume)
+
+    return lesion_files, behaviors, covariates, lesion_volumes, lesion_matrix
+
+
+def load_behaviors(lesion_folder, csv_file, max_score):
+    """
+    Read the lesion file paths, the behaviors scaled by max_score and the additional covariate columns of a behavior CSV.
+    """
     df = read_csv(csv_file)
 
     # Check for required columns
@@ -25,19 +51,15 @@ def load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_ou
 
     print('\nBehavior after:\n', behaviors)
 
-    # Compute lesion volumes
-
-    print("\nComputing lesion volumes...")
-    lesion_volumes = []
-    for file in lesion_files:
-        lesion_img = nib.load(file)
-        lesion_data = lesion_img.get_fdata()
-        voxel_volume = np.prod(lesion_img.header.get_zooms())
-        lesion_volumes.append(np.sum(lesion_data > 0) * voxel_volume)
-    lesion_volumes = np.array(lesion_volumes).reshape(-1, 1)
-
     # Load additional covariates
     covariates = df.iloc[:, 2:].values  # Assuming additional covariates start from the 3rd column
+    return lesion_files, behaviors, covariates
+
+
+def prepare_covariates(covariates, lesion_volumes, do_regress_out_lesion_volume=False):
+    """
+    Z-transformed covariates of the CSV, with the lesion volumes first if they are regressed out, or None if the CSV has none.
+    """
     if covariates.shape[1] > 0:
         print(f"Loaded {covariates.shape[1]} additional covariates",end='')
         # Combine lesion volumes with additional covariates
@@ -53,5 +75,4 @@ def load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_ou
     else:
         print("No additional covariates found in the CSV.")
         covariates = None
-
-    return lesion_files, behaviors, covariates, lesion_volumes
\ No newline at end of file
+    return covariates
\ No newline at end of file
@@ -0,0 +1,136 @@
+import numpy as np
+
+NULL_DISTRIBUTION_NAME = "null_distributions.npy"
+
+
+def create_null_store(path, n_permutations, n_voxels):
+    """
+    Preallocate the (permutations x voxels) float32 null distribution as an .npy file, and return it memory-mapped.
+    Permutation workers open the same file with open_null_store(path, 'r+') and write their rows in place.
+    """
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_permutations, n_voxels))
+
+
+def open_null_store(path, mode='r'):
+    return np.load(path, mmap_mode=mode)
+
+
+def write_null_rows(null_store, permutation_ids, maps):
+    # permutation_ids is a contiguous chunk, so its rows are one slice of the file
+    null_store[permutation_ids[0]:permutation_ids[-1] + 1] = maps
+    null_store.flush()
+
+
+class NullStatistics:
+    """
+    Streaming voxelwise statistics of the null maps: count, mean and M2 (sum of squared deviations from the mean),
+    plus the number of null values >= the observed map and the maximum of every null map, in permutation order.
+    Memory is O(voxels + permutations): the null maps themselves are not kept.
+
+    update() folds in a batch of maps and merge() another NullStatistics, both with Chan et al.'s pairwise update,
+    so chunks can be accumulated in separate workers and merged; merging in chunk order gives the same result
+    for any number of workers. Counts are per voxel, as adaptive runs stop updating the voxels they retire;
+    maxima are only kept for maps covering every voxel.
+    """
+
+    def __init__(self, n_voxels):
+        self.count = np.zeros(n_voxels, dtype=np.int64)
+        self.mean = np.zeros(n_voxels)
+        self.m2 = np.zeros(n_voxels)
+        self.exceedances = np.zeros(n_voxels, dtype=np.int64)
+        self.maxima = np.zeros(0)
+
+    def update(self, maps, observed):
+        # maps: (permutations x voxels) batch of null maps
+        maps = np.asarray(maps, dtype=np.float64)
+        batch = NullStatistics(maps.shape[1])
+        batch.count = np.full(maps.shape[1], len(maps), dtype=np.int64)
+        batch.mean = maps.mean(axis=0)
+        batch.m2 = ((maps - batch.mean) ** 2).sum(axis=0)
+        batch.exceedances = (maps >= observed).sum(axis=0)
+        batch.maxima = maps.max(axis=1)
+        return self.merge(batch)
+
+    def merge(self, other, columns=None):
+        """
+        Merge other into self. With columns (voxel indices), other only covers those voxels, and its maxima are dropped.
+        """
+        if not np.any(other.count):
+            return self
+        if columns is None:
+            columns = slice(None)
+            self.maxima = np.concatenate([self.maxima, other.maxima])
+        count = self.count[columns]
+        total = count + other.count
+        delta = other.mean - self.mean[columns]
+        self.mean[columns] = self.mean[columns] + delta * (other.count / total)
+        self.m2[columns] = self.m2[columns] + other.m2 + delta ** 2 * (count * other.count / total)
+        self.exceedances[columns] = self.exceedances[columns] + other.exceedances
+        self.count[columns] = total
+        return self
+
+    def copy(self):
+        statistics = NullStatistics(0)
+        statistics.count = self.count.copy()
+        statistics.mean = self.mean.copy()
+        statistics.m2 = self.m2.copy()
+        statistics.exceedances = self.exceedances.copy()
+        statistics.maxima = self.maxima.copy()
+        return statistics
+
+    def take(self, indices):
+        """
+        Statistics of the voxels at indices, e.g. every voxel's unique lesion pattern, with the same maxima.
+        """
+        statistics = NullStatistics(0)
+        statistics.count = self.count[indices]
+        statistics.mean = self.mean[indices]
+        statistics.m2 = self.m2[indices]
+        statistics.exceedances = self.exceedances[indices]
+        statistics.maxima = self.maxima
+        return statistics
+
+    @property
+    def variance(self):
+        return self.m2 / np.maximum(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def zmap(self, observed):
+        # Voxels whose null distribution has no spread get a z of 0
+        std = self.std
+        return np.divide(observed - self.mean, std, out=np.zeros_like(std), where=std > 0)
+
+    def p_values(self, retired=None):
+        """
+        Voxelwise empirical p-values of the observed map, (exceedances + 1) / (permutations + 1).
+        Voxels retired by a sequential stopping rule get Besag and Clifford's exceedances / permutations instead.
+        """
+        p_values = (self.exceedances + 1) / (self.count + 1)
+        if retired is not None:
+            p_values[retired] = self.exceedances[retired] / self.count[retired]
+        return p_values
+
+    def fwe_p_values(self, observed):
+        """
+        Family-wise error corrected p-values from the max-statistic null: the fraction of permutations whose
+        maximum over all voxels reaches the observed value.
+        """
+        sorted_maxima = np.sort(self.maxima)
+        max_exceedances = len(sorted_maxima) - np.searchsorted(sorted_maxima, observed, side='left')
+        return (max_exceedances + 1) / (len(sorted_maxima) + 1)
+
+    def fwe_threshold(self, alpha):
+        """
+        Max-statistic threshold at level alpha: observed values strictly above it have an FWE p-value <= alpha.
+        It is inf when alpha < 1 / (permutations + 1), as no value can then be significant.
+        """
+        # A significant value may be reached by at most k - 1 permutation maxima
+        k = int(np.floor(alpha * (len(self.maxima) + 1) + 1e-9))
+        if k < 1:
+            return np.inf
+        if k > len(self.maxima):
+            return -np.inf
+        return np.sort(self.maxima)[::-1][k - 1]
\ No newline at end of file
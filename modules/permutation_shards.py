@@ -0,0 +1,192 @@
+import json
+import os
+import shutil
+import socket
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from modules.null_distribution import NullStatistics
+from modules.permutation_test import PERMUTATION_CHUNK_SIZE, PermutationPool, run_permutations
+
+SHARD_FOLDER_NAME = "shards"
+MERGE_LOCK_NAME = "merge.lock"
+
+# Permutations per shard, a multiple of PERMUTATION_CHUNK_SIZE so shards split the permutations into the same chunks
+# as a single-node run
+SHARD_SIZE = 500
+
+
+def shard_ranges(n_permutations, shard_size=SHARD_SIZE):
+    return [(start, min(start + shard_size, n_permutations)) for start in range(0, n_permutations, shard_size)]
+
+
+def shard_result_path(shard_folder, shard):
+    return Path(shard_folder) / f"shard_{shard:05d}.npz"
+
+
+def shard_lock_path(shard_folder, shard):
+    return Path(shard_folder) / f"shard_{shard:05d}.lock"
+
+
+def merge_lock_path(shard_folder):
+    return Path(shard_folder) / MERGE_LOCK_NAME
+
+
+def remove_shards(output_folder):
+    # Shards left in the folder by an earlier run, which a new run must not merge
+    shutil.rmtree(Path(output_folder) / SHARD_FOLDER_NAME, ignore_errors=True)
+
+
+def claim_lock(path, seed_entropy):
+    """
+    Atomically create a lock file with O_CREAT | O_EXCL, which also holds on NFS (v3 and later); False if it exists.
+    The lock records the host, pid and time of its worker and the permutation seed of its run; deleting it lets
+    another worker claim it again.
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), 'seed_entropy': str(seed_entropy)}, f)
+    return True
+
+
+def claim_shard(shard_folder, shard, seed_entropy):
+    return claim_lock(shard_lock_path(shard_folder, shard), seed_entropy)
+
+
+def check_shard_run(shard_folder, seed_entropy):
+    """
+    Raise a ValueError if a shard or lock of shard_folder was made by a run with another permutation seed,
+    e.g. by a worker of an earlier run in the same output folder that was still running when this one started.
+    """
+    for path in sorted(Path(shard_folder).glob("shard_?????.npz")):
+        with np.load(path) as arrays:
+            shard_seed = str(arrays['seed_entropy']) if 'seed_entropy' in arrays.files else None
+        if shard_seed != str(seed_entropy):
+            raise ValueError(f"{path} belongs to another run (permutation seed {shard_seed}, not {seed_entropy}); "
+                             f"delete {shard_folder} and start the run again.")
+    for path in sorted(Path(shard_folder).glob("*.lock")):
+        try:
+            with open(path) as f:
+                shard_seed = json.load(f).get('seed_entropy')
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Released or still being written by its worker
+            continue
+        if shard_seed != str(seed_entropy):
+            raise ValueError(f"{path} was claimed by a worker of another run (permutation seed {shard_seed}, not {seed_entropy}); "
+                             f"stop that worker, delete {shard_folder} and start the run again.")
+
+
+def save_shard(path, chunk_statistics, seed_entropy):
+    """
+    Save the NullStatistics of every chunk of a shard, in permutation order, so that the merge can replay
+    the chunk-by-chunk merges of a single-node run, with the permutation seed of the run that made it.
+    Written to a temporary file first, then renamed.
+    """
+    tmp_path = path.with_name(f"{path.stem}.{uuid.uuid4().hex}.tmp.npz")
+    np.savez(tmp_path,
+             count=np.stack([s.count for s in chunk_statistics]), mean=np.stack([s.mean for s in chunk_statistics]),
+             m2=np.stack([s.m2 for s in chunk_statistics]), exceedances=np.stack([s.exceedances for s in chunk_statistics]),
+             maxima=np.concatenate([s.maxima for s in chunk_statistics]),
+             chunk_sizes=np.array([len(s.maxima) for s in chunk_statistics]), seed_entropy=str(seed_entropy))
+    os.replace(tmp_path, path)
+
+
+def load_shard(path):
+    # The chunk NullStatistics of a shard, as saved by save_shard
+    with np.load(path) as arrays:
+        maxima = np.split(arrays['maxima'], np.cumsum(arrays['chunk_sizes'])[:-1])
+        chunk_statistics = []
+        for i in range(len(arrays['chunk_sizes'])):
+            statistics = NullStatistics(0)
+            statistics.count = arrays['count'][i]
+            statistics.mean = arrays['mean'][i]
+            statistics.m2 = arrays['m2'][i]
+            statistics.exceedances = arrays['exceedances'][i]
+            statistics.maxima = maxima[i]
+            chunk_statistics.append(statistics)
+    return chunk_statistics
+
+
+def shard_status(output_folder, n_permutations):
+    """
+    Lists of the finished shards, the claimed but unfinished ones (with their lock contents) and the unclaimed ones.
+    """
+    shard_folder = Path(output_folder) / SHARD_FOLDER_NAME
+    finished, claimed, unclaimed = [], [], []
+    for shard in range(len(shard_ranges(n_permutations))):
+        if shard_result_path(shard_folder, shard).exists():
+            finished.append(shard)
+        elif shard_lock_path(shard_folder, shard).exists():
+            with open(shard_lock_path(shard_folder, shard)) as f:
+                claimed.append((shard, f.read()))
+        else:
+            unclaimed.append(shard)
+    return finished, claimed, unclaimed
+
+
+def run_permutation_shards(kernel, features, behaviors, null_params, n_permutations, observed, seed_entropy, output_folder, n_jobs=1, solver="libsvm", beta_weighting="mean", model="svr"):
+    """
+    Work through the permutation shards of output_folder/shards, shared by every worker node (e.g. on NFS).
+    The first worker runs the search and writes the checkpoint of a fresh run (clearing shards/); the others join it
+    with resume_svr_lsm_iteration. Sharded runs keep no null matrix and are not adaptive.
+    Each worker claims every unclaimed shard, runs its permutations (with their usual per-permutation seeds) and saves
+    its chunk statistics. Once no shard is left to claim, the shards are merged if they are all finished, and the
+    NullStatistics returned, identical to that of a single-node run; None if other workers are still running shards.
+    Only the worker that claims merge.lock merges, so workers finishing together do not all write the maps; the lock
+    is kept, as once its checkpoint records every permutation no worker gets here again.
+    """
+    shard_folder = Path(output_folder) / SHARD_FOLDER_NAME
+    shard_folder.mkdir(parents=True, exist_ok=True)
+    check_shard_run(shard_folder, seed_entropy)
+    shards = shard_ranges(n_permutations)
+    # One set of workers for every shard this node runs, made once it claims its first one
+    pool = None
+    try:
+        for shard, (start, stop) in enumerate(shards):
+            if shard_result_path(shard_folder, shard).exists() or not claim_shard(shard_folder, shard, seed_entropy):
+                continue
+            shard_time = time.time()
+            try:
+                if pool is None:
+                    pool = PermutationPool(kernel, features, behaviors, null_params, None, observed, seed_entropy, n_jobs, solver, beta_weighting, model,
+                                           n_chunks=SHARD_SIZE // PERMUTATION_CHUNK_SIZE)
+                chunk_statistics = [statistics for _, statistics in
+                                    run_permutations(kernel, features, behaviors, null_params, n_permutations, None, observed,
+                                                     seed_entropy, start=start, stop=stop, pool=pool)]
+                save_shard(shard_result_path(shard_folder, shard), chunk_statistics, seed_entropy)
+            except BaseException:
+                # Released, so that this or another worker can run the shard again
+                os.remove(shard_lock_path(shard_folder, shard))
+                raise
+            print(f"Shard {shard + 1}/{len(shards)}: permutations {start}-{stop - 1} in {time.time() - shard_time:.1f} s")
+    finally:
+        if pool is not None:
+            pool.close()
+
+    finished, claimed, _ = shard_status(output_folder, n_permutations)
+    if len(finished) < len(shards):
+        print(f"{len(finished)}/{len(shards)} shards finished, {len(claimed)} still running on other workers: "
+              f"merge them with merge_permutation_shards once they are done")
+        return None
+
+    # Every shard, including those saved by other workers since the check above, must come from this run
+    check_shard_run(shard_folder, seed_entropy)
+    if not claim_lock(merge_lock_path(shard_folder), seed_entropy):
+        print(f"Every shard is finished and another worker is merging them (see {merge_lock_path(shard_folder)})")
+        return None
+    print(f"Merging {len(shards)} shards...")
+    null_statistics = NullStatistics(len(observed))
+    try:
+        for shard in range(len(shards)):
+            for statistics in load_shard(shard_result_path(shard_folder, shard)):
+                null_statistics.merge(statistics)
+    except BaseException:
+        os.remove(merge_lock_path(shard_folder))
+        raise
+    return null_statistics
\ No newline at end of file
@@ -0,0 +1,209 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from modules.compute_beta_map import compute_beta_map, compute_beta_maps
+from modules.epsilon_svr import fit_svr
+from modules.kernel_ridge import ls_svr_operator
+from modules.null_distribution import NullStatistics, open_null_store, write_null_rows
+from modules.shared_array import create_shared_array, attach_shared_array, release_shared_array, share_features, attach_features, resolve_n_jobs
+
+# Per-process state of the permutation workers, set once by init_permutation_worker
+worker_state = {}
+
+# Permutations are handed out in fixed-size chunks, so the work split never depends on the number of workers
+PERMUTATION_CHUNK_SIZE = 10
+
+# Adaptive runs only retire voxels every this many permutations (a multiple of PERMUTATION_CHUNK_SIZE),
+# so which permutations cover which voxels does not depend on the number of workers either
+ADAPTIVE_ROUND_SIZE = 100
+
+
+def permutation_rng(seed_entropy, permutation_id):
+    # Independent stream of every permutation, derived from one SeedSequence, whatever process runs it
+    return np.random.default_rng(np.random.SeedSequence(seed_entropy, spawn_key=(permutation_id,)))
+
+
+def permutation_maps(kernel, features, behaviors, null_params, seed_entropy, permutation_ids, solver="libsvm", beta_weighting="mean", model="svr"):
+    """
+    Fit one SVR on shuffled behaviors per permutation id and return the (permutations x voxels) maps of compute_beta_map
+    on the given features (the column subset of a round's active voxels, in adaptive runs).
+    Every fit starts cold, so it runs on libsvm whatever the solver: with shuffled targets the previous permutation's
+    dual is a worse start than zero.
+
+    With model="kernel_ridge", kernel is the LS-SVR dual operator (see ls_svr_operator) and the whole chunk is solved
+    at once: its dual coefficients are one product with the (patients x permutations) block of shuffled behaviors,
+    and its dual-weighted maps a second one.
+    The maps have the features' dtype; only the patient x patient fits run in float64.
+    """
+    if model == "kernel_ridge":
+        targets = np.column_stack([permutation_rng(seed_entropy, permutation_id).permutation(behaviors)
+                                   for permutation_id in permutation_ids])
+        return compute_beta_maps((kernel @ targets).T, features)
+    maps = np.zeros((len(permutation_ids), features.shape[1]), dtype=features.dtype)
+    for row, permutation_id in enumerate(permutation_ids):
+        perm_behaviors = permutation_rng(seed_entropy, permutation_id).permutation(behaviors)
+
+        svr_permutation = fit_svr(kernel, perm_behaviors, null_params['C'], null_params['epsilon'], solver)
+
+        maps[row] = compute_beta_map(svr_permutation, features, beta_weighting)
+    return maps
+
+
+def init_permutation_worker(kernel_spec, features_spec, active_spec, null_store_path, observed, behaviors, null_params, seed_entropy, solver, beta_weighting, model):
+    worker_state['kernel_shm'], worker_state['kernel'] = attach_shared_array(*kernel_spec)
+    worker_state['feature_blocks'], worker_state['features'] = attach_features(features_spec)
+    worker_state['active_shm'], worker_state['active'] = attach_shared_array(*active_spec)
+    worker_state['null_store'] = None if null_store_path is None else open_null_store(null_store_path, 'r+')
+    worker_state['observed'] = observed
+    worker_state['behaviors'] = behaviors
+    worker_state['null_params'] = null_params
+    worker_state['seed_entropy'] = seed_entropy
+    worker_state['solver'] = solver
+    worker_state['beta_weighting'] = beta_weighting
+    worker_state['model'] = model
+    worker_state['call'] = None
+
+
+def permutation_maps_task(args):
+    # The maps go straight into the shared null store, if any; only the ids and the chunk's statistics travel back to the parent
+    permutation_ids, call = args
+    if worker_state['call'] != call:
+        # First chunk of a new run_permutations call: take its active columns once, for all its chunks
+        columns = None if worker_state['active'].all() else np.flatnonzero(worker_state['active'])
+        worker_state['call_features'] = worker_state['features'] if columns is None else worker_state['features'][:, columns]
+        worker_state['call_observed'] = worker_state['observed'] if columns is None else worker_state['observed'][columns]
+        worker_state['call'] = call
+    maps = permutation_maps(worker_state['kernel'], worker_state['call_features'], worker_state['behaviors'],
+                            worker_state['null_params'], worker_state['seed_entropy'], permutation_ids,
+                            worker_state['solver'], worker_state['beta_weighting'], worker_state['model'])
+    if worker_state['null_store'] is not None:
+        write_null_rows(worker_state['null_store'], permutation_ids, maps)
+    return permutation_ids, NullStatistics(maps.shape[1]).update(maps, worker_state['call_observed'])
+
+
+def resolved_voxels(null_statistics, n_permutations, alpha):
+    """
+    Besag-Clifford style sequential stopping: a voxel is resolved once it has so many exceedances that its p-value
+    would be > alpha even after all n_permutations, i.e. exceedances > alpha * (n_permutations + 1) - 1.
+An adaptive run treats n_permutations as a budget: every ADAPTIVE_ROUND_SIZE permutations it stops computing the
+beta maps of the resolved voxels, and it ends once every voxel is resolved. Decisions at alpha are unchanged, and
+effective_permutations.nii.gz holds the permutations each voxel got. Adaptive runs keep no null matrix and no FWE
+maps, as the permutation maxima need every voxel.
+    """
+    return (null_statistics.exceedances > alpha * (n_permutations + 1) - 1) & (null_statistics.count > 0)
+
+
+def ordered_results(executor, function, task_args, window):
+    """
+    Submit tasks to the executor, at most `window` at a time, and yield their results in task order.
+    """
+    task_args = iter(task_args)
+    pending = deque(executor.submit(function, args) for args in islice(task_args, window))
+    while pending:
+        result = pending.popleft().result()
+        for args in islice(task_args, 1):
+            pending.append(executor.submit(function, args))
+        yield result
+
+
+class PermutationPool:
+    """
+    The permutation workers of one null model, set up once and reused by every run_permutations call on it,
+    e.g. every round of an adaptive run or every shard of a node. With n_jobs > 1 (or -1 for all cores) it is a process
+    pool whose workers read the kernel and the features from shared memory and write their rows into the memory-mapped
+    null store; each call's voxel columns are passed through a shared mask of active voxels, and every worker takes its
+    column subset of the features once per call. n_chunks, if known, caps the number of workers.
+    model="kernel_ridge" replaces the kernel by its LS-SVR dual operator, computed once here.
+    """
+
+    def __init__(self, kernel, features, behaviors, null_params, null_store_path, observed, seed_entropy, n_jobs=1, solver="libsvm", beta_weighting="mean", model="svr", n_chunks=None):
+        if model == "kernel_ridge":
+            kernel = ls_svr_operator(kernel, null_params['C'])[0]
+        self.kernel = kernel
+        self.features = features
+        self.behaviors = behaviors
+        self.null_params = null_params
+        self.observed = observed
+        self.seed_entropy = seed_entropy
+        self.solver = solver
+        self.beta_weighting = beta_weighting
+        self.model = model
+        self.null_store = None if null_store_path is None else open_null_store(null_store_path, 'r+')
+        self.n_jobs = resolve_n_jobs(n_jobs)
+        if n_chunks is not None:
+            self.n_jobs = min(self.n_jobs, max(n_chunks, 1))
+        self.calls = 0
+        self.executor = None
+        if self.n_jobs == 1:
+            return
+
+        self.kernel_shm, self.shared_kernel = create_shared_array(kernel.shape, np.float64)
+        self.shared_kernel[...] = kernel
+        self.feature_blocks, features_spec = share_features(features)
+        self.active_shm, self.active = create_shared_array((features.shape[1],), bool)
+        initargs = ((self.kernel_shm.name, kernel.shape, np.float64), features_spec, (self.active_shm.name, (features.shape[1],), bool),
+                    null_store_path, observed, behaviors, null_params, seed_entropy, solver, beta_weighting, model)
+        self.executor = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=init_permutation_worker, initargs=initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown()
+        self.executor = None
+        del self.shared_kernel, self.active
+        release_shared_array(self.kernel_shm)
+        release_shared_array(self.active_shm)
+        for block in self.feature_blocks:
+            release_shared_array(block)
+
+    def run(self, chunks, columns=None):
+        # (permutation_ids, NullStatistics) of every chunk, in order, with the maps and statistics restricted to columns
+        self.calls += 1
+        if self.executor is not None:
+            # The previous call's chunks have all finished, so no worker still reads the mask
+            self.active[...] = columns is None
+            if columns is not None:
+                self.active[columns] = True
+            yield from ordered_results(self.executor, permutation_maps_task, [(permutation_ids, self.calls) for permutation_ids in chunks], 2 * self.n_jobs)
+            return
+        features = self.features if columns is None else self.features[:, columns]
+        observed = self.observed if columns is None else self.observed[columns]
+        for permutation_ids in chunks:
+            maps = permutation_maps(self.kernel, features, self.behaviors, self.null_params, self.seed_entropy, permutation_ids, self.solver, self.beta_weighting, self.model)
+            if self.null_store is not None:
+                write_null_rows(self.null_store, permutation_ids, maps)
+            yield permutation_ids, NullStatistics(maps.shape[1]).update(maps, observed)
+
+
+def run_permutations(kernel, features, behaviors, null_params, n_permutations, null_store_path, observed, seed_entropy, n_jobs=1, solver="libsvm", beta_weighting="mean", start=0, stop=None, columns=None, model="svr", pool=None):
+    """
+    Run the permutations, yielding (permutation_ids, NullStatistics of the chunk against the observed map)
+    for every finished chunk, in permutation order.
+    Unless null_store_path is None, every map is also written to the null store there (see create_null_store).
+    With columns, the maps and statistics only cover those voxels (the observed map is still a full one).
+    With n_jobs > 1 (or -1 for all cores) the chunks run on a process pool (see PermutationPool); pool reuses
+    one made by the caller for several calls, whose kernel, features and settings then replace the arguments.
+    Every permutation has its own seed, so the maps are identical for any number of workers.
+    start (a multiple of PERMUTATION_CHUNK_SIZE) skips the permutations already done, to resume a run,
+    and stop ends the run early, for adaptive rounds.
+    model="kernel_ridge" solves each chunk in one shot with the kernel's LS-SVR dual operator.
+    """
+    if stop is None:
+        stop = n_permutations
+    chunks = [np.arange(chunk_start, min(chunk_start + PERMUTATION_CHUNK_SIZE, stop))
+              for chunk_start in range(start, stop, PERMUTATION_CHUNK_SIZE)]
+    if pool is not None:
+        yield from pool.run(chunks, columns)
+        return
+    with PermutationPool(kernel, features, behaviors, null_params, null_store_path, observed, seed_entropy,
+                         n_jobs, solver, beta_weighting, model, n_chunks=len(chunks)) as pool:
+        yield from pool.run(chunks, columns)
\ No newline at end of file
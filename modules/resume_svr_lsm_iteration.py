@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from modules.checkpoint import load_run_config, read_checkpoint_file
+from modules.permutation_shards import SHARD_FOLDER_NAME, merge_lock_path, shard_status
+from modules.run_svr_lsm_iteration import run_svr_lsm_iteration
+
+
+def resume_svr_lsm_iteration(output_folder, n_jobs=None):
+    """
+    Resume the run saved in output_folder with the arguments of its run_config.json, continuing its permutations
+    from the last checkpoint. n_jobs may be changed; the results do not depend on it.
+    For a run with shards=True, this is how another machine joins as a shard worker.
+    """
+    config = load_run_config(output_folder)
+    config['symptom_folder'] = Path(config['symptom_folder'])
+    if n_jobs is not None:
+        config['n_jobs'] = n_jobs
+    run_svr_lsm_iteration(**config, resume=output_folder)
+
+
+def merge_permutation_shards(output_folder, n_jobs=None):
+    """
+    Merge the finished shards of a shards=True run and write its maps and report, as the last shard worker does.
+    Lists the shards that are not finished instead, with the lock of those claimed by a worker: delete the lock
+    of a shard whose worker died, and it is run again by the next worker to join. A merge.lock left by a worker that
+    died while merging is reported too; delete it to merge here. Once merged, this writes the maps and report again.
+    """
+    config = load_run_config(output_folder)
+    finished, claimed, unclaimed = shard_status(output_folder, config['n_permutations'])
+    if claimed or unclaimed:
+        print(f"{len(finished)} shards finished, {len(claimed)} claimed, {len(unclaimed)} unclaimed; not merging yet")
+        for shard, lock in claimed:
+            print(f"\tshard {shard} claimed by {lock}")
+        return
+    lock = merge_lock_path(Path(output_folder) / SHARD_FOLDER_NAME)
+    merged = read_checkpoint_file(output_folder)['completed_permutations'] == config['n_permutations']
+    if lock.exists() and not merged:
+        print(f"The shards are being merged, or were by a worker that died, as {lock} holds: {lock.read_text()}")
+        print(f"Delete {lock} if that worker is not running, then merge again")
+        return
+    resume_svr_lsm_iteration(output_folder, n_jobs)
\ No newline at end of file
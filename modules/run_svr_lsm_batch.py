@@ -0,0 +1,113 @@
+from modules.time_func import get_current_datetime_for_filename
+from modules.time_func import easy_time
+from modules.lesion_matrix import load_lesion_matrix
+from modules.lesion_cache import load_cached_lesion_matrix
+from modules.load_lesions_and_behaviors import load_behaviors, prepare_covariates
+from modules.filter_voxels_by_patient_count import filter_voxels_by_patient_count
+from modules.regress_covariates_from_behavior import regress_covariates_from_behavior
+from modules.kernel_engine import KernelEngine
+from modules.voxel_patterns import unique_patterns
+from modules.svr_lsm import svr_lsm
+from modules.run_svr_lsm_iteration import report_svr_lsm
+from modules.checkpoint import save_run_config
+
+import shutil
+import time
+from pathlib import Path
+import numpy as np
+
+
+def run_svr_lsm_batch(symptom_folder, analyses, normalize_vector, min_patient_count, param_grid, n_permutations, alpha, n_splits, num_slices, n_jobs=1, cache_folder=None, packed=False, sparse=False, mask_mode="brain", permutation_seed=None, solver="libsvm", beta_weighting="mean", adaptive=False, model="svr", search="grid", n_trials=20, deduplicate_patterns=True, dtype="float32"):
+    """
+    Run several behaviors of one lesion set, e.g.
+        analyses = [{'csv_name': "Fluency.csv", 'behaviour_name': "Fluency", 'max_score': 4, 'do_regress_out_lesion_volume': True},
+                    {'csv_name': "Naming.csv", 'behaviour_name': "Naming", 'max_score': 60, 'do_regress_out_lesion_volume': False}]
+    Every CSV in symptom_folder must list the same lesion files of symptom_folder/data, in the same order; their
+    additional columns are each analysis' own covariates.
+    The lesions are loaded and filtered once, the unique patterns and patient x patient kernels computed once, and
+    every behavior then gets its own search, permutations and the usual output folder, with the run_config.json of the
+    equivalent run_svr_lsm_iteration call, so any of them can be resumed with resume_svr_lsm_iteration.
+    """
+    start_time = time.time()
+    symptom = symptom_folder.name
+    lesion_folder = symptom_folder / 'data'
+
+    print(f"Loading the behavioral data of {len(analyses)} analyses...")
+    loaded = [load_behaviors(lesion_folder, symptom_folder / analysis['csv_name'], analysis['max_score']) for analysis in analyses]
+    lesion_files = loaded[0][0]
+    for analysis, (files, _, _) in zip(analyses, loaded):
+        if files != lesion_files:
+            raise ValueError(f"{analysis['csv_name']} does not list the same lesion files as {analyses[0]['csv_name']}, "
+                             f"in the same order; run it with run_svr_lsm_iteration instead.")
+
+    print("Loading lesion files...")
+    if cache_folder is not None:
+        lesion_matrix = load_cached_lesion_matrix(lesion_files, cache_folder, n_jobs=n_jobs, packed=packed)
+    else:
+        lesion_matrix = load_lesion_matrix(lesion_files, n_jobs=n_jobs, packed=packed)
+    lesion_volumes = lesion_matrix.lesion_volumes()
+    print("\n\tTIME ELAPSED : ", easy_time(int(time.time() - start_time)), end="\n\n")
+
+    datetime = get_current_datetime_for_filename()
+    output_folders = []
+    for analysis in analyses:
+        output_folder = Path(f"outputs/{symptom}_{Path(analysis['csv_name']).stem}_{n_permutations}_results_{datetime}")
+        output_folder.mkdir(parents=True, exist_ok=True)
+        save_run_config(output_folder, {'symptom_folder': symptom_folder, 'csv_name': analysis['csv_name'],
+                                        'behaviour_name': analysis['behaviour_name'],
+                                        'do_regress_out_lesion_volume': analysis['do_regress_out_lesion_volume'],
+                                        'normalize_vector': normalize_vector, 'max_score': analysis['max_score'],
+                                        'min_patient_count': min_patient_count, 'param_grid': param_grid,
+                                        'n_permutations': n_permutations, 'alpha': alpha, 'n_splits': n_splits, 'num_slices': num_slices,
+                                        'n_jobs': n_jobs, 'cache_folder': cache_folder, 'packed': packed, 'sparse': sparse,
+                                        'mask_mode': mask_mode, 'permutation_seed': permutation_seed, 'solver': solver,
+                                        'beta_weighting': beta_weighting, 'adaptive': adaptive, 'model': model, 'search': search, 'n_trials': n_trials,
+                                        'deduplicate_patterns': deduplicate_patterns, 'dtype': dtype})
+        output_folders.append(output_folder)
+
+    # Filtered once; the overlap maps (and analysis mask) are copied to every output folder
+    min_patient_count, features, masker, voxel_index = filter_voxels_by_patient_count(lesion_matrix, min_patient_count, normalize_vector, output_folders[0], sparse, mask_mode, np.dtype(dtype))
+    for output_folder in output_folders[1:]:
+        for path in output_folders[0].glob("*.nii.gz"):
+            shutil.copy(path, output_folder / path.name)
+
+    pattern_index = None
+    pattern_counts = None
+    if deduplicate_patterns:
+        n_voxels = features.shape[1]
+        features, pattern_counts, pattern_index = unique_patterns(features)
+        print(f"{features.shape[1]} unique lesion patterns in {n_voxels} voxels ({n_voxels / max(features.shape[1], 1):.1f}x fewer columns)")
+    kernel_engine = KernelEngine(features, weights=pattern_counts)
+    print("\n\tTIME ELAPSED : ", easy_time(int(time.time() - start_time)), end="\n\n")
+
+    for i, (analysis, (_, behaviors, csv_covariates), output_folder) in enumerate(zip(analyses, loaded, output_folders), start=1):
+        analysis_time = time.time()
+        print(f"\nAnalysis {i}/{len(analyses)}: {analysis['behaviour_name']} ({analysis['csv_name']})")
+        covariates = prepare_covariates(csv_covariates, lesion_volumes, analysis['do_regress_out_lesion_volume'])
+        behaviors = regress_covariates_from_behavior(behaviors, covariates)
+
+        svr_params, coef_map, nifti_zmap, zmap = svr_lsm(features=features,
+                                                          behaviors=behaviors,
+                                                          masker=masker,
+                                                          voxel_index=voxel_index,
+                                                          output_folder=output_folder,
+                                                          param_grid=param_grid,
+                                                          n_permutations=n_permutations,
+                                                          alpha=alpha,
+                                                          n_splits=n_splits,
+                                                          n_jobs=n_jobs,
+                                                          permutation_seed=permutation_seed,
+                                                          solver=solver,
+                                                          beta_weighting=beta_weighting,
+                                                          adaptive=adaptive,
+                                                          model=model,
+                                                          search=search,
+                                                          n_trials=n_trials,
+                                                          deduplicate_patterns=deduplicate_patterns,
+                                                          kernel_engine=kernel_engine,
+                                                          pattern_index=pattern_index)
+
+        report_svr_lsm(output_folder, svr_params, nifti_zmap, zmap, analysis['behaviour_name'], n_permutations, alpha,
+                       min_patient_count, num_slices, lesion_files, behaviors, covariates, lesion_volumes, analysis_time)
+
+    print("\n\tTOTAL TIME TAKEN : ", easy_time(int(time.time() - start_time)))
\ No newline at end of file
@@ -6,12 +6,19 @@ from modules.filter_voxels_by_patient_count import filter_voxels_by_patient_coun
 from modules.regress_covariates_from_behavior import regress_covariates_from_behavior
 from modules.svr_lsm import svr_lsm
 from modules.save_report import save_report
+from modules.checkpoint import save_run_config
 
 import time
 from pathlib import Path
 import numpy as np
 
-def run_svr_lsm_iteration(symptom_folder, csv_name,behaviour_name,do_regress_out_lesion_volume, normalize_vector, max_score,min_patient_count, param_grid, n_permutations, alpha, n_splits, num_slices):
+def run_svr_lsm_iteration(symptom_folder, csv_name,behaviour_name,do_regress_out_lesion_volume, normalize_vector, max_score,min_patient_count, param_grid, n_permutations, alpha, n_splits, num_slices, n_jobs=1, cache_folder=None, packed=False, sparse=False, mask_mode="brain", permutation_seed=None, solver="libsvm", beta_weighting="mean", adaptive=False, model="svr", search="grid", n_trials=20, deduplicate_patterns=True, dtype="float32", shards=False, output_folder=None, resume=None):
+    """
+    Map one behavior of symptom_folder with svr_lsm (see it for the mapping options) and write its report.
+    dtype="float64" runs the whole pipeline in float64 instead of float32, as a reference for compare_zmaps.
+    output_folder defaults to outputs/<symptom>_<n_permutations>_results_<date>; resume=<output_folder> continues
+    an interrupted run there (see resume_svr_lsm_iteration).
+    """
     # base_folder = Path.cwd()  # CURRENT DIRECTORY
     start_time = time.time()
 
@@ -23,27 +30,64 @@ def run_svr_lsm_iteration(symptom_folder, csv_name,behaviour_name,do_regress_out
     lesion_folder = symptom_folder / 'data'
     csv_file = symptom_folder / csv_name
 
-    lesion_files, behaviors, covariates, lesion_volumes = load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_out_lesion_volume)
+    lesion_files, behaviors, covariates, lesion_volumes, lesion_matrix = load_lesions_and_behaviors(lesion_folder, csv_file, max_score, do_regress_out_lesion_volume, n_jobs, cache_folder, packed)
     print("\n\tTIME ELAPSED : ", easy_time(int(time.time() - start_time)),end="\n\n")
 
     behaviors = regress_covariates_from_behavior(behaviors, covariates)
     print("\n\tTIME ELAPSED : ", easy_time(int(time.time() - start_time)), end="\n\n")
-    output_folder = f"outputs/{symptom}_{n_permutations}_results_{get_current_datetime_for_filename()}"
-    output_folder = Path(output_folder)
-    Path(output_folder).mkdir(parents=True, exist_ok=True)
+    if resume is None:
+        if output_folder is None:
+            output_folder = f"outputs/{symptom}_{n_permutations}_results_{get_current_datetime_for_filename()}"
+        output_folder = Path(output_folder)
+        Path(output_folder).mkdir(parents=True, exist_ok=True)
+        save_run_config(output_folder, {'symptom_folder': symptom_folder, 'csv_name': csv_name, 'behaviour_name': behaviour_name,
+                                        'do_regress_out_lesion_volume': do_regress_out_lesion_volume, 'normalize_vector': normalize_vector,
+                                        'max_score': max_score, 'min_patient_count': min_patient_count, 'param_grid': param_grid,
+                                        'n_permutations': n_permutations, 'alpha': alpha, 'n_splits': n_splits, 'num_slices': num_slices,
+                                        'n_jobs': n_jobs, 'cache_folder': cache_folder, 'packed': packed, 'sparse': sparse,
+                                        'mask_mode': mask_mode, 'permutation_seed': permutation_seed, 'solver': solver,
+                                        'beta_weighting': beta_weighting, 'adaptive': adaptive, 'model': model, 'search': search, 'n_trials': n_trials,
+                                        'deduplicate_patterns': deduplicate_patterns, 'dtype': dtype, 'shards': shards})
+    else:
+        output_folder = Path(resume)
 
-    min_patient_count, features, masker = filter_voxels_by_patient_count(lesion_files, min_patient_count, normalize_vector,output_folder)
+    min_patient_count, features, masker, voxel_index = filter_voxels_by_patient_count(lesion_matrix, min_patient_count, normalize_vector,output_folder, sparse, mask_mode, np.dtype(dtype))
     print("\n\tTIME ELAPSED : ", easy_time(int(time.time() - start_time)), end="\n\n")
     # Perform SVR-based lesion-symptom mapping
-    svr_params, coef_map, nifti_zmap, zmap = svr_lsm(features=features,
-                                                      behaviors=behaviors,
-                                                      masker=masker,
-                                                      output_folder=output_folder,
-                                                      param_grid=param_grid,
-                                                      n_permutations=n_permutations,
-                                                      alpha=alpha,
-                                                      n_splits=n_splits)
-
+    results = svr_lsm(features=features,
+                      behaviors=behaviors,
+                      masker=masker,
+                      voxel_index=voxel_index,
+                      output_folder=output_folder,
+                      param_grid=param_grid,
+                      n_permutations=n_permutations,
+                      alpha=alpha,
+                      n_splits=n_splits,
+                      n_jobs=n_jobs,
+                      permutation_seed=permutation_seed,
+                      solver=solver,
+                      beta_weighting=beta_weighting,
+                      adaptive=adaptive,
+                      model=model,
+                      search=search,
+                      n_trials=n_trials,
+                      deduplicate_patterns=deduplicate_patterns,
+                      shards=shards,
+                      resume=resume is not None)
+    if results is None:
+        # A shard worker done before the others: the last one to finish (or merge_permutation_shards) writes the maps
+        print("\n\tTOTAL TIME TAKEN : ", easy_time(int(time.time() - start_time)))
+        return
+    svr_params, coef_map, nifti_zmap, zmap = results
+
+    report_svr_lsm(output_folder, svr_params, nifti_zmap, zmap, behaviour_name, n_permutations, alpha, min_patient_count,
+                   num_slices, lesion_files, behaviors, covariates, lesion_volumes, start_time)
+
+
+def report_svr_lsm(output_folder, svr_params, nifti_zmap, zmap, behaviour_name, n_permutations, alpha, min_patient_count, num_slices, lesion_files, behaviors, covariates, lesion_volumes, start_time):
+    """
+    Atlas clusters of the z-map and the HTML report of one analysis.
+    """
     # Dataset statistics
     num_lesions = len(lesion_files)
     num_patients = len(behaviors)
@@ -0,0 +1,77 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+
+def resolve_n_jobs(n_jobs):
+    # n_jobs=-1 (or None) uses every core, like scikit-learn
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(int(n_jobs), 1)
+
+
+def create_shared_array(shape, dtype):
+    """
+    Allocate a zeroed array in shared memory. Returns the SharedMemory block and the array viewing it.
+    """
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array[...] = 0
+    return shm, array
+
+
+def attach_shared_array(name, shape, dtype):
+    """
+    Attach to a shared array created by another process.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return shm, array
+
+
+def release_shared_array(shm):
+    shm.close()
+    shm.unlink()
+
+def share_features(features):
+    """
+    Copy a dense or CSR feature matrix into shared memory.
+    Returns the SharedMemory blocks (to release later) and a small picklable spec for attach_features.
+    A Fortran-ordered dense matrix keeps its layout (it is shared transposed), so BLAS sums in the same order
+    in the workers as in the parent.
+    """
+    transposed = not sparse.issparse(features) and features.flags['F_CONTIGUOUS'] and not features.flags['C_CONTIGUOUS']
+    if sparse.issparse(features):
+        arrays = {'data': features.data, 'indices': features.indices, 'indptr': features.indptr}
+    elif transposed:
+        arrays = {'dense': features.T}
+    else:
+        arrays = {'dense': np.ascontiguousarray(features)}
+    blocks = []
+    spec = {'shape': features.shape, 'sparse': sparse.issparse(features), 'transposed': transposed, 'arrays': {}}
+    for name, array in arrays.items():
+        shm, shared = create_shared_array(array.shape, array.dtype)
+        shared[...] = array
+        blocks.append(shm)
+        spec['arrays'][name] = (shm.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+
+def attach_features(spec):
+    # Read-only view of features shared by share_features
+    blocks, arrays = [], {}
+    for name, (shm_name, shape, dtype) in spec['arrays'].items():
+        shm, arrays[name] = attach_shared_array(shm_name, shape, dtype)
+        arrays[name].flags.writeable = False
+        blocks.append(shm)
+    if spec['sparse']:
+        features = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=spec['shape'], copy=False)
+    elif spec['transposed']:
+        features = arrays['dense'].T
+    else:
+        features = arrays['dense']
+    return blocks, features
\ No newline at end of file
@@ -1,13 +1,5 @@
-from sklearn.model_selection import KFold
-from sklearn.svm import SVR
-import pandas as pd
 import numpy as np
-from nilearn import masking
 import nibabel as nib
-from itertools import product
-import pickle
-from sklearn.utils import shuffle
-from sklearn.metrics import mean_squared_error
 
 from nilearn.image import threshold_img
 
@@ -20,204 +12,231 @@ import time
 from tqdm import tqdm
 
 from modules.time_func import easy_time
-
-
-def svr_lsm(features, behaviors, masker, output_folder, param_grid, n_permutations=1, alpha=0.05, n_splits=5):
+from modules.fast_unmask import fast_unmask
+from modules.kernel_engine import KernelEngine
+from modules.grid_search import grid_search
+from modules.hyperparameter_search import successive_halving_search, tpe_search
+from modules.epsilon_svr import fit_svr
+from modules.compute_beta_map import compute_beta_map
+from modules.permutation_test import ADAPTIVE_ROUND_SIZE, PERMUTATION_CHUNK_SIZE, PermutationPool, resolved_voxels, run_permutations
+from modules.null_distribution import NULL_DISTRIBUTION_NAME, NullStatistics, create_null_store
+from modules.checkpoint import save_checkpoint, load_checkpoint
+from modules.cv_cache import CV_CACHE_NAME, CVScoreCache
+from modules.voxel_patterns import VOXEL_PATTERNS_NAME, unique_patterns, expand_patterns
+from modules.permutation_shards import remove_shards, run_permutation_shards
+
+
+def svr_lsm(features, behaviors, masker, voxel_index, output_folder, param_grid, n_permutations=1, alpha=0.05, n_splits=5, n_jobs=1, permutation_seed=None, solver="libsvm", beta_weighting="mean", resume=False, checkpoint_interval=60, save_null_distribution=True, adaptive=False, model="svr", search="grid", n_trials=20, cv_cache_folder=None, deduplicate_patterns=True, kernel_engine=None, pattern_index=None, shards=False):
     """
     Perform SVR-based lesion-symptom mapping with K-fold cross-validation and permutation testing.
+    Features can be a dense array or a scipy sparse (CSR) matrix; every map is scattered back into the masker grid
+    through voxel_index and saved in the features' dtype. All fits share the RBF kernels of one KernelEngine.
+    Besides the parametric z-map, the permutations give voxelwise and FWE-corrected p-values (see NullStatistics);
+    save_null_distribution=False skips writing the (permutations x voxels) null matrix.
+    The other options are described where they are implemented: fit_svr (solver, model), compute_beta_map
+    (beta_weighting), grid_search and hyperparameter_search (search, n_trials), CVScoreCache (cv_cache_folder, by
+    default cv_score_cache next to output_folder), run_permutations (permutation_seed, n_jobs), resolved_voxels
+    (adaptive), save_checkpoint (resume, checkpoint_interval), unique_patterns (deduplicate_patterns, or the
+    pattern_index and kernel_engine of run_svr_lsm_batch) and run_permutation_shards (shards).
+    Returns (best_params, coef_map, nifti_zmap, zmap), or None on a shard worker that finishes while shards are still
+    running elsewhere.
     """
+    if model == "kernel_ridge" and beta_weighting != "dual":
+        # Every patient supports an LS-SVR, so the unweighted mean would not depend on the behaviors
+        print("Kernel ridge maps use the dual-weighted beta")
+        beta_weighting = "dual"
+    if shards and adaptive:
+        raise ValueError("Adaptive permutations cannot be sharded: their rounds need every permutation before them.")
+    if shards and save_null_distribution:
+        print("Sharded permutations do not save the null distribution")
+        save_null_distribution = False
+    if adaptive and save_null_distribution:
+        print("Adaptive permutations do not save the null distribution")
+        save_null_distribution = False
     print("Running SVR analysis...")
-
-    # Perform grid search with K-fold cross-validation
-    print("Performing grid search with K-fold cross-validation...")
-    cv = KFold(n_splits=n_splits, shuffle=True, random_state=42)
-
-    param_combinations = list(product(param_grid['C'], param_grid['gamma'], param_grid['epsilon']))
-
-    best_params = {'C': param_grid['C'][0], 'gamma': param_grid['gamma'][0], 'epsilon': param_grid['epsilon'][0]}
-
-    best_score = float('inf')
-    best_iteration = 1
-
-    patient_count = len(features)
-    all_scores = []
-    # Iterate over all combinations of hyperparameters
-    i = 1
-    num_iter = len(param_combinations)
-
-    for C, gamma, epsilon in param_combinations:
-        print(f"\nIteration: i={i}/{num_iter}, Testing parameters: C={C}, gamma={gamma}, epsilon={epsilon}")
-        iter_time = time.time()
-
-        scores = []
-        no_of_sv = []
-
-        split_ctr = 1
-        for train_idx, test_idx in cv.split(features):
-            print(f"Split :{split_ctr}/{n_splits}")
-            split_ctr += 1
-            X_train, X_test = features[train_idx], features[test_idx]
-            y_train, y_test = behaviors[train_idx], behaviors[test_idx]
-
-            svr = SVR(kernel='rbf', C=C, gamma=gamma, epsilon=epsilon)
-            svr.fit(X_train, y_train)
-
-            print(f"\tno. of support vectors : {len(svr.support_)}/{patient_count}", )
-            no_of_sv.append(len(svr.support_))
-
-            predictions = svr.predict(X_test)
-            score = mean_squared_error(y_test, predictions)
-
-            # default coef of determination metrics
-            print(f"\tscore : {score}", )
-
-            scores.append(score)
-
-        # Average score across all folds
-        avg_score = np.mean(scores)
-        avg_no_of_sv = np.mean(no_of_sv)
-
-        all_scores.append((i, C, gamma, epsilon, avg_score, scores, avg_no_of_sv, no_of_sv))
-
-        print(f"\nAverage score for mse: {avg_score:.4f}")
-        print(scores, "\n")
-
-        # Update best parameters if current score is better
-        if avg_score < best_score:
-            best_iteration = i
-            best_score = avg_score
-            best_params = {'C': C, 'gamma': gamma, 'epsilon': epsilon}
-
-        i = i + 1
-        print(f"Best iteration: {best_iteration}, Best score: {best_score:.4f}->0, Current Score: {avg_score:.4f}")
-        print(f"Iteration {best_iteration} parameters: C = {best_params['C']}, gamma = {best_params['gamma']}, epsilon = {best_params['epsilon']}")
-
-        print(f"Iteration time: {easy_time(int(time.time() - iter_time))}")
-
-
-    columns = [
-        "Iteration", "C", "Gamma", "Epsilon", "Avg_Score", "Scores", "Avg_Support_Vectors", "Support_Vectors"
-    ]
-
-    df = pd.DataFrame(all_scores, columns=columns)
-    del all_scores
-
-    # Save to CSV
-    output_path = output_folder / 'results_and_scores.csv'
-    df.to_csv(output_path, index=False)
-    print(f"Results and scores saved to {output_path}")
-    del df
-
-    print(f"Best parameters found: {best_params} with score {best_score:.4f} in iteration {best_iteration}/{num_iter}")
-    # Train SVR with the best parameters
-    svr_best = SVR(kernel='rbf', C=best_params['C'], gamma=best_params['gamma'], epsilon=best_params['epsilon'])
-    svr_best.fit(features, behaviors)
-    coef_map = svr_best.support_vectors_.mean(axis=0)
-
-    #saving beta map
-    nifti_coef_map = masking.unmask(coef_map, masker)
-    nifti_coef_path = output_folder / 'beta_map.nii.gz'
-    nib.save(nifti_coef_map, nifti_coef_path)
+    # Maps are computed and saved in the features' dtype; the null accumulators and the z-map stay float64 until saved
+    map_dtype = features.dtype
+
+    if pattern_index is None and deduplicate_patterns:
+        n_voxels = features.shape[1]
+        features, _, pattern_index = unique_patterns(features)
+        print(f"{features.shape[1]} unique lesion patterns in {n_voxels} voxels ({n_voxels / max(features.shape[1], 1):.1f}x fewer columns)")
+    if pattern_index is not None and save_null_distribution:
+        np.save(output_folder / VOXEL_PATTERNS_NAME, pattern_index)
+
+    if kernel_engine is None:
+        pattern_counts = None if pattern_index is None else np.bincount(pattern_index, minlength=features.shape[1])
+        kernel_engine = KernelEngine(features, weights=pattern_counts)
+    results_file = output_folder / NULL_DISTRIBUTION_NAME if save_null_distribution else None
+
+    checkpoint = load_checkpoint(output_folder) if resume else None
+    if checkpoint is None and resume and shards:
+        raise ValueError(f"No checkpoint in {output_folder} yet: start the other shard workers once the first one has finished its search.")
+    if checkpoint is None:
+        if cv_cache_folder is None:
+            cv_cache_folder = Path(output_folder).parent / CV_CACHE_NAME
+        cv_cache = CVScoreCache(cv_cache_folder, kernel_engine, behaviors, solver, model)
+        if search == "grid":
+            best_params = grid_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, n_jobs, solver, model, cv_cache)
+        elif search == "halving":
+            best_params = successive_halving_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, solver, model, cv_cache)
+        elif search == "tpe":
+            best_params = tpe_search(kernel_engine, behaviors, param_grid, n_splits, output_folder, solver, model, n_trials, cv_cache=cv_cache)
+        else:
+            raise ValueError(f"Unknown search '{search}', expected 'grid', 'halving' or 'tpe'.")
+
+        # Train SVR with the best parameters
+        svr_best = fit_svr(kernel_engine.kernel(best_params['gamma']), behaviors, best_params['C'], best_params['epsilon'], solver, model=model)
+        coef_map = compute_beta_map(svr_best, features, beta_weighting)
+
+        #saving beta map
+        nifti_coef_map = fast_unmask(expand_patterns(coef_map, pattern_index), voxel_index, masker, map_dtype)
+        nifti_coef_path = output_folder / 'beta_map.nii.gz'
+        nib.save(nifti_coef_map, nifti_coef_path)
+
+        seed_entropy = np.random.SeedSequence(permutation_seed).entropy
+        # (permutations x voxels) float32 null distribution, memory-mapped; the workers write their rows in place
+        if save_null_distribution:
+            create_null_store(results_file, n_permutations, len(coef_map))
+        # Null mean, M2 and exceedance counts, merged chunk by chunk as the permutations finish
+        null_statistics = NullStatistics(len(coef_map))
+        completed = 0
+        retired = np.zeros(len(coef_map), dtype=bool)
+        if shards:
+            remove_shards(output_folder)
+        save_checkpoint(output_folder, completed, seed_entropy, best_params, coef_map, null_statistics, retired)
+    else:
+        best_params = checkpoint['best_params']
+        coef_map = checkpoint['coef_map']
+        seed_entropy = checkpoint['seed_entropy']
+        null_statistics = checkpoint['null_statistics']
+        completed = checkpoint['completed_permutations']
+        retired = checkpoint['retired']
+        if len(coef_map) != features.shape[1]:
+            raise ValueError(f"The checkpoint in {output_folder} has {len(coef_map)} columns, not {features.shape[1]}; "
+                             f"resume with the deduplicate_patterns setting of the interrupted run.")
+        print(f"Resuming from the checkpoint in {output_folder}: {completed}/{n_permutations} permutations done")
 
     # Permutation testing
     print("\nPerforming permutation testing...")
 
     null_params = best_params
-
-    results_file = output_folder / "null_distributions.pkl"
-    # Open the results file in binary write mode
-    with open(results_file, 'wb') as f:
-        permute_time = time.time()
-
-        # Wrap the range with tqdm to show the progress bar
-        with tqdm(range(n_permutations), desc="Running permutations", unit="permutation", mininterval=1, ncols=100, dynamic_ncols=True, leave=True) as pbar:
-            for i in pbar:
-                # Shuffle the behaviors for this permutation
-                perm_behaviors = shuffle(behaviors, random_state=None)
-
-                svr_permutation = SVR(kernel='rbf',
-                                      C=null_params['C'],
-                                      gamma=null_params['gamma'],
-                                      epsilon=null_params['epsilon'])
-
-                svr_permutation.fit(features, perm_behaviors)
-
-                # Compute the mean of support vectors for this permutation
-                vector_mean = svr_permutation.support_vectors_.mean(axis=0)
-
-                # Save the result to the file incrementally
-                pickle.dump(vector_mean, f)
-
-                # Clear the perm_result from memory
-                del vector_mean
-
-                # Update the progress bar, displaying elapsed time and ETA
-                elapsed_time = time.time() - permute_time
-                pbar.set_postfix(elapsed=f"{easy_time(elapsed_time)}",eta=f"{easy_time((elapsed_time / (i + 1)) * (n_permutations - i - 1))}")
-
-    print(f"Permutations completed. Null distribution saved to {results_file}\n")
-
-    # Z-map Calculations
-    # Incremental calculation of mean and std from saved null distributions
-    sum_null = None
-    sum_null_squared = None
-    num_permutations = 0
-
-    with open(results_file, 'rb') as f:
-        while True:
+    null_kernel = kernel_engine.kernel(null_params['gamma'])
+    print(f"Permutation seed: {seed_entropy}")
+
+    if shards and completed < n_permutations:
+        merged_statistics = run_permutation_shards(null_kernel, features, behaviors, null_params, n_permutations, coef_map,
+                                                   seed_entropy, output_folder, n_jobs, solver, beta_weighting, model)
+        if merged_statistics is None:
+            return None
+        null_statistics = merged_statistics
+        completed = n_permutations
+
+    permute_time = time.time()
+    checkpoint_time = time.time()
+    resumed = completed
+
+    # Wrap the range with tqdm to show the progress bar
+    with tqdm(total=n_permutations, initial=completed, desc="Running permutations", unit="permutation", mininterval=1, ncols=100, dynamic_ncols=True, leave=True) as pbar:
+        # One set of workers (and shared copy of the kernel and features) for every adaptive round
+        with PermutationPool(null_kernel, features, behaviors, null_params, results_file, coef_map, seed_entropy, n_jobs, solver, beta_weighting, model,
+                             n_chunks=-(-(n_permutations - completed) // PERMUTATION_CHUNK_SIZE)) as pool:
+            # The last consistent (completed, null_statistics) pair, for the checkpoint of an interrupted run
+            state = (completed, null_statistics)
             try:
-                # Load one result at a time
-                perm_result = pickle.load(f)
-
-                # Initialize accumulators on the first iteration
-                if sum_null is None:
-                    sum_null = np.zeros_like(perm_result)
-                    sum_null_squared = np.zeros_like(perm_result)
+                while completed < n_permutations:
+                    columns, stop = None, n_permutations
+                    if adaptive:
+                        # Voxels are only retired at round boundaries
+                        if completed % ADAPTIVE_ROUND_SIZE == 0:
+                            retired = resolved_voxels(null_statistics, n_permutations, alpha)
+                        if retired.all():
+                            break
+                        if retired.any():
+                            columns = np.flatnonzero(~retired)
+                        stop = min(completed - completed % ADAPTIVE_ROUND_SIZE + ADAPTIVE_ROUND_SIZE, n_permutations)
+
+                    for permutation_ids, chunk_statistics in run_permutations(null_kernel, features, behaviors, null_params, n_permutations, results_file, coef_map,
+                                                                              seed_entropy, start=completed, stop=stop, columns=columns, pool=pool):
+                        # Merged into a copy and swapped in with its permutation count in one assignment, so an
+                        # interrupt during the merge leaves state as it was
+                        state = (completed + len(permutation_ids), null_statistics.copy().merge(chunk_statistics, columns))
+                        completed, null_statistics = state
+
+                        if time.time() - checkpoint_time >= checkpoint_interval:
+                            save_checkpoint(output_folder, completed, seed_entropy, best_params, coef_map, null_statistics, retired)
+                            checkpoint_time = time.time()
+
+                        # Update the progress bar, displaying elapsed time and ETA
+                        pbar.update(len(permutation_ids))
+                        elapsed_time = time.time() - permute_time
+                        pbar.set_postfix(elapsed=f"{easy_time(elapsed_time)}",eta=f"{easy_time((elapsed_time / (completed - resumed)) * (n_permutations - completed))}")
+            except KeyboardInterrupt:
+                completed, null_statistics = state
+                save_checkpoint(output_folder, completed, seed_entropy, best_params, coef_map, null_statistics, retired)
+                print(f"\nInterrupted after {completed}/{n_permutations} permutations; the run can be resumed from {output_folder}")
+                raise
+    save_checkpoint(output_folder, completed, seed_entropy, best_params, coef_map, null_statistics, retired)
+
+    if pattern_index is not None:
+        # Every voxel gets the beta, null statistics and retirement of its pattern; the maxima are the same
+        coef_map = coef_map[pattern_index]
+        null_statistics = null_statistics.take(pattern_index)
+        retired = retired[pattern_index]
+
+    if adaptive:
+        print(f"Adaptive stopping: {np.count_nonzero(retired)}/{len(retired)} voxels retired early, "
+              f"{null_statistics.count.mean():.0f} permutations per voxel on average ({completed}/{n_permutations} run)")
+        nifti_effective = fast_unmask(null_statistics.count.astype(np.int32), voxel_index, masker)
+        nib.save(nifti_effective, output_folder / 'effective_permutations.nii.gz')
+
+    if save_null_distribution:
+        print(f"Permutations completed. Null distribution saved to {results_file}\n")
+    else:
+        print("Permutations completed.\n")
 
-                # Update sum and sum of squares
-                sum_null += perm_result
-                sum_null_squared += perm_result ** 2
-                num_permutations += 1
-            except EOFError:
-                break
-
-    # Compute mean and standard deviation
-    mean_null = sum_null / num_permutations
+    # Z-map Calculations
+    mean_null = null_statistics.mean
 
     # saving null map
-    nifti_null_map = masking.unmask(mean_null, masker)
+    nifti_null_map = fast_unmask(mean_null, voxel_index, masker, map_dtype)
     nifti_null_path = output_folder / 'null_map.nii.gz'
     nib.save(nifti_null_map, nifti_null_path)
 
-    std_null = np.sqrt((sum_null_squared / num_permutations) - mean_null ** 2 + 1e-8)
-
     # Compute z-map
-    zmap = (coef_map - mean_null) / std_null
+    zmap = null_statistics.zmap(coef_map)
 
     # Plot the Histogram
 
     zmap_flat = zmap[zmap != 0]
 
-    plt.hist(zmap_flat, bins=50, density=True, alpha=0.6, color='blue', label='Z-map distribution')
-
-    # Fit a normal distribution (optional)
-    mean, std = np.mean(zmap_flat), np.std(zmap_flat)
-    x = np.linspace(min(zmap_flat), max(zmap_flat), 100)
-    pdf = norm.pdf(x, mean, std)
-
-    # Overlay the normal distribution
-    plt.plot(x, pdf, 'r-', label=f'Normal dist (μ={mean:.2f}, σ={std:.2f})')
-
-    # Set x-axis to be symmetric around 0
-    plt.xlim(left=-max(abs(min(zmap_flat)), abs(max(zmap_flat))), right=max(abs(min(zmap_flat)), abs(max(zmap_flat))))
-
-    # Add labels and legend
-    plt.title('Z-Map Distribution')
-    plt.xlabel('Z-score')
-    plt.ylabel('Density')
-    plt.legend()
-
-    plt.savefig(output_folder / 'z_value_distribution.png')
+    if len(zmap_flat) == 0:
+        # Every null distribution has zero variance, e.g. with a single permutation
+        print(f"Warning: the z-map is undefined with {completed} permutation(s) (at least 2 are needed); "
+              f"it is saved as zeros and no z-value histogram is plotted.")
+    else:
+        plt.hist(zmap_flat, bins=50, density=True, alpha=0.6, color='blue', label='Z-map distribution')
+
+        # Fit a normal distribution (optional)
+        mean, std = np.mean(zmap_flat), np.std(zmap_flat)
+        x = np.linspace(min(zmap_flat), max(zmap_flat), 100)
+        pdf = norm.pdf(x, mean, std)
+
+        # Overlay the normal distribution
+        plt.plot(x, pdf, 'r-', label=f'Normal dist (μ={mean:.2f}, σ={std:.2f})')
+
+        # Set x-axis to be symmetric around 0
+        plt.xlim(left=-max(abs(min(zmap_flat)), abs(max(zmap_flat))), right=max(abs(min(zmap_flat)), abs(max(zmap_flat))))
+
+        # Add labels and legend
+        plt.title('Z-Map Distribution')
+        plt.xlabel('Z-score')
+        plt.ylabel('Density')
+        plt.legend()
+
+        plt.savefig(output_folder / 'z_value_distribution.png')
+        # Closed, so the next analysis of a batch starts from an empty figure
+        plt.close()
     del zmap_flat
 
     zmap_threshold_output_folder = output_folder / "thresholded_zmaps"
@@ -225,7 +244,7 @@ def svr_lsm(features, behaviors, masker, output_folder, param_grid, n_permutatio
 
     # Unmask the z-map back to a 3D image
     print("Unmasking z-map...")
-    nifti_zmap = masking.unmask(zmap, masker)
+    nifti_zmap = fast_unmask(zmap, voxel_index, masker, map_dtype)
     nifti_zmap_path = output_folder / 'zmap.nii.gz'
     nib.save(nifti_zmap, nifti_zmap_path)
 
@@ -249,4 +268,20 @@ def svr_lsm(features, behaviors, masker, output_folder, param_grid, n_permutatio
     nifti_zmap_thresholded_path = zmap_threshold_output_folder / 'zmap_p001.nii.gz'
     nib.save(nifti_zmap_p001, nifti_zmap_thresholded_path)
 
+    # Non-parametric inference: voxelwise and max-statistic (FWE) permutation p-values, saved as 1 - p
+    p_map = null_statistics.p_values(retired)
+    nib.save(fast_unmask(1 - p_map, voxel_index, masker, map_dtype), output_folder / 'one_minus_p.nii.gz')
+    print(f"Uncorrected p <= {alpha}: {np.count_nonzero(p_map <= alpha)} voxels")
+
+    # Adaptive runs stop permuting resolved voxels, so their maxima are not maxima over the whole map: no FWE maps
+    if not adaptive and len(null_statistics.maxima):
+        fwe_p_map = null_statistics.fwe_p_values(coef_map)
+        nib.save(fast_unmask(1 - fwe_p_map, voxel_index, masker, map_dtype), output_folder / 'one_minus_p_fwe.nii.gz')
+
+        fwe_threshold = null_statistics.fwe_threshold(alpha)
+        significant = fwe_p_map <= alpha
+        print(f"FWE threshold at alpha={alpha}: beta > {fwe_threshold:.6g}, {np.count_nonzero(significant)} voxels")
+        nifti_beta_fwe = fast_unmask(np.where(significant, coef_map, 0), voxel_index, masker, map_dtype)
+        nib.save(nifti_beta_fwe, output_folder / 'beta_map_fwe.nii.gz')
+
     return best_params, coef_map, nifti_zmap, zmap
@@ -0,0 +1,73 @@
+import numpy as np
+from sklearn.svm import SVR
+
+from modules.epsilon_svr import EpsilonSVR, full_dual
+from modules.kernel_engine import KernelEngine
+
+# Largest differences accepted between EpsilonSVR and SVR(kernel='precomputed') on the same problem. Both stop at
+# libsvm's KKT tolerance (1e-3) rather than at the exact optimum, and libsvm's shrinking changes its working sets, so
+# where many duals reach C the two duals can differ by a few percent of C along nearly flat directions of the
+# objective. Their dual objectives and predictions are compared instead: over 18 random problem sets the objectives
+# differed by up to 6e-6 (relative) and the predictions by up to 1.6e-3, cold or warm-started.
+OBJECTIVE_TOLERANCE = 1e-4
+PREDICTION_TOLERANCE = 5e-3
+
+# (gamma x mean squared distance, C path, epsilon) of the validation problems: the repo's default C path, where few
+# duals reach C, and one where most do
+VALIDATION_PROBLEMS = [(1.0, [50, 40, 30, 20, 10, 5], 0.1),
+                       (5.0, [50, 40, 30, 20, 10, 5], 0.01),
+                       (1.0, [1, 0.5, 0.2, 0.1, 0.05, 0.02], 0.05)]
+
+
+def dual_objective(kernel, y, dual, epsilon):
+    # libsvm's epsilon-SVR objective in beta = alpha - alpha*: 1/2 beta' K beta + epsilon |beta|_1 - y' beta
+    return 0.5 * dual @ kernel @ dual + epsilon * np.abs(dual).sum() - y @ dual
+
+
+def compare_with_libsvm(kernel, y, C, epsilon, initial_dual=None):
+    """
+    Fit EpsilonSVR (warm-started from initial_dual if given) and SVR(kernel='precomputed') on one problem.
+    Returns whether their dual objectives and training predictions agree to within the tolerances, the relative
+    objective difference, the largest prediction and dual (relative to C) differences, and EpsilonSVR's dual
+    (to warm-start the next C of a path).
+    """
+    reference = SVR(kernel='precomputed', C=C, epsilon=epsilon).fit(kernel, y)
+    reference_dual = full_dual(reference, len(y))
+    svr = EpsilonSVR(C=C, epsilon=epsilon).fit(kernel, y, initial_dual)
+    reference_objective = dual_objective(kernel, y, reference_dual, epsilon)
+    objective_difference = abs(dual_objective(kernel, y, svr.dual_, epsilon) - reference_objective) / max(abs(reference_objective), 1e-12)
+    prediction_difference = np.abs(svr.predict(kernel) - reference.predict(kernel)).max()
+    dual_difference = np.abs(svr.dual_ - reference_dual).max() / C
+    agree = objective_difference <= OBJECTIVE_TOLERANCE and prediction_difference <= PREDICTION_TOLERANCE
+    return agree, objective_difference, prediction_difference, dual_difference, svr.dual_
+
+
+def validate_epsilon_svr(n_patients=(40, 200), n_voxels=2000, lesion_fraction=0.1, seed=0):
+    """
+    Check EpsilonSVR against sklearn's SVR(kernel='precomputed') on random binary lesion matrices of n_patients
+    patients, with behaviors driven by a few voxels: every problem of VALIDATION_PROBLEMS is fitted cold and along
+    its C path, each C warm-started from the previous one's dual, as in the grid search with solver="smo".
+    Prints the differences of every fit and returns True if all of them are within the tolerances.
+    """
+    rng = np.random.default_rng(seed)
+    all_agree = True
+    for n in n_patients:
+        features = (rng.random((n, n_voxels)) < lesion_fraction).astype(np.float64)
+        behaviors = features[:, :20].mean(axis=1) + rng.normal(0, 0.05, n)
+        behaviors = (behaviors - behaviors.min()) / (behaviors.max() - behaviors.min())
+        kernel_engine = KernelEngine(features)
+        mean_sq_distance = kernel_engine.sq_distances.mean()
+        for gamma_scale, C_values, epsilon in VALIDATION_PROBLEMS:
+            kernel = kernel_engine.kernel(gamma_scale / mean_sq_distance)
+            dual = None
+            for C in C_values:
+                for start in ("cold", "warm"):
+                    agree, objective_difference, prediction_difference, dual_difference, fitted_dual = compare_with_libsvm(kernel, behaviors, C, epsilon, dual if start == "warm" else None)
+                    all_agree = all_agree and agree
+                    print(f"{n} patients, gamma={gamma_scale}/{mean_sq_distance:.0f}, C={C}, epsilon={epsilon}, {start}: "
+                          f"objective {objective_difference:.2g}, predictions {prediction_difference:.2g}, "
+                          f"duals {dual_difference:.2g} C{'' if agree else ' ABOVE TOLERANCE'}")
+                dual = fitted_dual
+    print(f"EpsilonSVR {'agrees' if all_agree else 'does not agree'} with libsvm to within "
+          f"{OBJECTIVE_TOLERANCE} (relative objective) and {PREDICTION_TOLERANCE} (predictions)")
+    return all_agree
\ No newline at end of file
@@ -0,0 +1,51 @@
+import numpy as np
+from scipy import sparse
+
+VOXEL_PATTERNS_NAME = "voxel_patterns.npy"
+
+
+def unique_patterns(features):
+    """
+    Collapse the voxels whose feature columns are identical across patients into unique lesion patterns.
+    Returns the (patients x patterns) matrix of unique columns, in order of first occurrence, the number of voxels
+    of every pattern, and the (int32) pattern of every voxel, so that patterns[:, pattern_index] == features.
+    Columns are compared by their bytes, so the collapse is exact.
+    svr_lsm fits, maps and permutes the patterns, with kernels weighting every pattern by its number of voxels so they
+    are unchanged, and expands the maps back to voxels before saving them; its null distribution has one column per
+    pattern, and voxel_patterns.npy gives every voxel's column.
+    """
+    n_voxels = features.shape[1]
+    if sparse.issparse(features):
+        columns = features.tocsc()
+        columns.sort_indices()
+        indptr, indices, data = columns.indptr, columns.indices, columns.data
+        # The lesioned patients and their values, hashed as one bytes key per voxel
+        patterns = {}
+        first_voxels = []
+        pattern_index = np.empty(n_voxels, dtype=np.int32)
+        for voxel in range(n_voxels):
+            start, stop = indptr[voxel], indptr[voxel + 1]
+            key = indices[start:stop].tobytes() + data[start:stop].tobytes()
+            pattern = patterns.setdefault(key, len(patterns))
+            if pattern == len(first_voxels):
+                first_voxels.append(voxel)
+            pattern_index[voxel] = pattern
+        first_voxels = np.asarray(first_voxels, dtype=np.int64)
+    else:
+        # One void item per voxel column; the transpose is only copied if the features are not Fortran-ordered
+        columns = np.ascontiguousarray(features.T)
+        keys = columns.view(np.dtype((np.void, columns.dtype.itemsize * columns.shape[1]))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        # Renumber the patterns in order of first occurrence, as for sparse features
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        pattern_index = rank[inverse.ravel()].astype(np.int32)
+        first_voxels = first[order]
+    pattern_counts = np.bincount(pattern_index, minlength=len(first_voxels))
+    return features[:, first_voxels], pattern_counts, pattern_index
+
+
+def expand_patterns(values, pattern_index):
+    # Pattern values back to one value per voxel; pattern_index=None means the values are already per voxel
+    return values if pattern_index is None else values[pattern_index]
\ No newline at end of file